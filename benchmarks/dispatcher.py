@@ -0,0 +1,87 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from speedclone.manager import TransferManager  # noqa
+
+
+class Task:
+    def __init__(self, i):
+        self.i = i
+
+    def get_relative_path(self):
+        return str(self.i)
+
+    def get_total(self):
+        return 0
+
+
+class Source:
+    def __init__(self, count, delay=0):
+        self.count = count
+        self.delay = delay
+
+    def iter_tasks(self):
+        # Stay silent for `delay` seconds first, like a slow listing.
+        time.sleep(self.delay)
+        for i in range(self.count):
+            yield Task(i)
+
+
+class Destination:
+    def get_worker(self, task):
+        def worker(bar):
+            pass
+
+        return worker
+
+
+class Bars:
+    def get_bar(self, task):
+        return None
+
+    def exit(self):
+        pass
+
+
+def run(count, workers, delay=0):
+    manager = TransferManager(
+        download_manager=Source(count, delay),
+        upload_manager=Destination(),
+        bar_manager=Bars(),
+        sleep_time=0,
+        max_workers=workers,
+    )
+    cpu = time.process_time()
+    start = time.perf_counter()
+    manager.run()
+    return time.perf_counter() - start, time.process_time() - cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", default=20000, type=int)
+    parser.add_argument("--workers", default=5, type=int)
+    parser.add_argument("--idle", default=2, type=float, help="Idle seconds.")
+    args = parser.parse_args()
+
+    elapsed, cpu = run(0, args.workers, args.idle)
+    print(
+        "idle       {:>8.2f} s wall  {:>8.3f} s cpu  ({:.1%} of a core)".format(
+            elapsed, cpu, cpu / elapsed
+        )
+    )
+
+    elapsed, cpu = run(args.tasks, args.workers)
+    print(
+        "dispatch   {:>8.2f} s wall  {:>8.3f} s cpu  {:>8.1f} us/task".format(
+            elapsed, cpu, elapsed / args.tasks * 1e6
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from speedclone.aio import AsyncTransferManager  # noqa
+from speedclone.client.google import GoogleDrive  # noqa
+from speedclone.manager import TransferManager  # noqa
+from speedclone.ratelimit import RateLimiter  # noqa
+from speedclone.session import PooledSession  # noqa
+from speedclone.transfers.filesystem import FileSystemTransferDownloadTask  # noqa
+from speedclone.transfers.googledrive import GoogleDriveTransferManager  # noqa
+
+
+class FakeDrive(BaseHTTPRequestHandler):
+    # Just enough of the Drive API for uploads into empty folders. Every
+    # reply waits `latency` seconds, like a round trip to the real one.
+    protocol_version = "HTTP/1.1"
+    latency = 0.05
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, headers=None):
+        time.sleep(self.latency)
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        self.reply({"files": []})
+
+    def do_POST(self):
+        self.read_body()
+        if "uploadType=resumable" in self.path:
+            location = "http://{}:{}/upload/session/{}".format(
+                *self.server.server_address, uuid.uuid4().hex
+            )
+            self.reply({}, {"Location": location})
+        else:
+            self.reply({"id": uuid.uuid4().hex})
+
+    do_PATCH = do_PUT = do_POST
+
+
+def serve(port, latency):
+    FakeDrive.latency = latency
+    ThreadingHTTPServer.request_queue_size = 4096
+    ThreadingHTTPServer(("127.0.0.1", port), FakeDrive).serve_forever()
+
+
+class Token:
+    def get_token(self):
+        return "token"
+
+
+class Source:
+    def __init__(self, root, paths):
+        self.root = root
+        self.paths = paths
+
+    def iter_tasks(self):
+        for path in self.paths:
+            yield FileSystemTransferDownloadTask(path, path[len(self.root) :])
+
+
+class Bar:
+    def init_bar(self, total, desc):
+        pass
+
+    def update(self, n):
+        pass
+
+    def close(self):
+        pass
+
+
+class Bars:
+    def __init__(self):
+        self.failed = 0
+
+    def get_bar(self, task):
+        return Bar()
+
+    def fail(self, e):
+        self.failed += 1
+
+    error = exists = sleep = fail
+
+    def exit(self):
+        pass
+
+
+def make_files(count, size):
+    root = tempfile.mkdtemp()
+    paths = []
+    for i in range(count):
+        folder = os.path.join(root, "dir{:03d}".format(i // 1000))
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, "file{:06d}.bin".format(i))
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        paths.append(path)
+    return root, paths
+
+
+def run(engine, root, paths, workers, clients):
+    PooledSession.pool_maxsize = workers
+    source = Source(root, paths)
+    dest = GoogleDriveTransferManager(
+        path="/bench",
+        clients=[GoogleDrive(Token()) for _ in range(clients)],
+        root="root",
+    )
+    bars = Bars()
+    manager_cls = AsyncTransferManager if engine == "asyncio" else TransferManager
+    manager = manager_cls(
+        download_manager=source,
+        upload_manager=dest,
+        bar_manager=bars,
+        sleep_time=0,
+        max_workers=workers,
+        max_queue=workers * 2,
+    )
+
+    peak = [0]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(0.05):
+            peak[0] = max(peak[0], threading.active_count())
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    manager.run()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    stop.set()
+    sampler.join()
+
+    print(
+        "{:<8} {:>6} workers  {:>7.2f} s  {:>8.1f} files/s  {:>7.2f} s cpu  "
+        "{:>5} threads  {} failed".format(
+            engine,
+            workers,
+            elapsed,
+            len(paths) / elapsed,
+            cpu,
+            peak[0],
+            bars.failed,
+        ),
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", default=5000, type=int)
+    parser.add_argument("--size", default=4096, type=int, help="Bytes per file.")
+    parser.add_argument("--latency", default=0.05, type=float)
+    parser.add_argument("--clients", default=4, type=int)
+    parser.add_argument("--port", default=8765, type=int)
+    parser.add_argument("--thread-workers", default="32,256", help="Comma separated.")
+    parser.add_argument("--async-workers", default="256,1000", help="Comma separated.")
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(
+        target=serve, args=(args.port, args.latency), daemon=True
+    )
+    server.start()
+    time.sleep(0.5)
+
+    base = "http://127.0.0.1:{}".format(args.port)
+    GoogleDrive.drive_url = base + "/drive/v3/files"
+    GoogleDrive.drive_upload_url = base + "/upload/drive/v3/files"
+    RateLimiter.rate = RateLimiter.max_rate = 10 ** 6
+
+    root, paths = make_files(args.files, args.size)
+    for workers in args.thread_workers.split(","):
+        run("thread", root, paths, int(workers), args.clients)
+    for workers in args.async_workers.split(","):
+        run("asyncio", root, paths, int(workers), args.clients)
+
+    shutil.rmtree(root)
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
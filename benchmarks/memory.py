@@ -0,0 +1,92 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from speedclone.manager import TransferManager  # noqa
+from speedclone.transfers.filesystem import FileSystemTransferDownloadTask  # noqa
+
+
+class Source:
+    def __init__(self, count):
+        self.count = count
+
+    def iter_tasks(self):
+        for i in range(self.count):
+            path = "/data/dir{:05d}/file{:08d}.bin".format(i // 1000, i)
+            yield FileSystemTransferDownloadTask(path, path[6:])
+
+
+class Destination:
+    def get_worker(self, task):
+        def worker(bar):
+            pass
+
+        return worker
+
+
+class Bars:
+    def get_bar(self, task):
+        return None
+
+    def exit(self):
+        pass
+
+
+def run_count(count, workers, queue_size):
+    manager = TransferManager(
+        download_manager=Source(count),
+        upload_manager=Destination(),
+        bar_manager=Bars(),
+        sleep_time=0,
+        max_workers=workers,
+        max_queue=queue_size,
+    )
+    start = time.perf_counter()
+    manager.run()
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        "{:>10} files  {:>8.1f} s  maxrss {:>8} KB".format(count, elapsed, rss),
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--counts",
+        default="10000,100000,1000000",
+        help="Comma separated file counts, e.g. add 10000000 for a long run.",
+    )
+    parser.add_argument("--workers", default=5, type=int)
+    parser.add_argument("--queue-size", default=1000, type=int)
+    parser.add_argument("--count", default=None, type=int)
+    args = parser.parse_args()
+
+    if args.count is not None:
+        run_count(args.count, args.workers, args.queue_size)
+        return
+
+    for count in args.counts.split(","):
+        subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--count",
+                count,
+                "--workers",
+                str(args.workers),
+                "--queue-size",
+                str(args.queue_size),
+            ],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from speedclone.transfers.filesystem import FileSystemTransferDownloadTask  # noqa
+
+MODES = ("buffered", "fadvise", "mmap")
+
+
+def page_cache_kb():
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("Cached:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def run_mode(path, mode, chunk_size):
+    task = FileSystemTransferDownloadTask(path, os.path.basename(path), mode)
+    cached = page_cache_kb()
+    start = time.perf_counter()
+    total = 0
+    for chunk in task.iter_data(chunk_size=chunk_size):
+        # Touch every page the way an uploader would.
+        total += sum(memoryview(chunk)[::4096])
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    size = os.path.getsize(path)
+    print(
+        "{:<10} {:>8.1f} MB/s  maxrss {:>8} KB  page cache {:>+9} KB".format(
+            mode, size / elapsed / 1024 ** 2, rss, page_cache_kb() - cached
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default=512, type=int, help="File size in MB.")
+    parser.add_argument("--chunk-size", default=30 * 1024 ** 2, type=int)
+    parser.add_argument("--file", default=None, help="Existing file to read.")
+    parser.add_argument("--mode", default=None, choices=MODES)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.file, args.mode, args.chunk_size)
+        return
+
+    path = args.file
+    if not path:
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1024 ** 2))
+
+    try:
+        for mode in MODES:
+            subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--file",
+                    path,
+                    "--mode",
+                    mode,
+                    "--chunk-size",
+                    str(args.chunk_size),
+                ],
+                check=True,
+            )
+    finally:
+        if not args.file:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
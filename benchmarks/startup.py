@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from engines import FakeDrive  # noqa
+
+
+class FakeGoogle(FakeDrive):
+    # Adds the token endpoint and notes when the first file bytes arrive.
+    first_byte = None
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if (
+            self.path.startswith("/upload/")
+            and "uploadType=resumable" not in self.path
+            and length
+            and FakeGoogle.first_byte is None
+        ):
+            FakeGoogle.first_byte = time.time()
+        self.rfile.read(length)
+
+    def do_POST(self):
+        if self.path.startswith("/token"):
+            self.read_body()
+            self.reply({"access_token": "token", "expires_in": 3600})
+        else:
+            super().do_POST()
+
+
+def make_accounts(root, count):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = (
+        rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        .private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        .decode()
+    )
+    folder = os.path.join(root, "accounts{}".format(count))
+    os.makedirs(folder)
+    for i in range(count):
+        with open(os.path.join(folder, "sa{:05d}.json".format(i)), "w") as f:
+            json.dump(
+                {
+                    "type": "service_account",
+                    "client_email": "sa{:05d}@bench.iam.gserviceaccount.com".format(i),
+                    "private_key": key,
+                },
+                f,
+            )
+    return folder
+
+
+def make_conf(root, accounts):
+    path = os.path.join(root, "conf{}.json".format(os.path.basename(accounts)))
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "configs": {
+                    "s": {"transfer": "fs"},
+                    "d": {
+                        "transfer": "gd",
+                        "service_account": True,
+                        "token_path": accounts,
+                        "root": "root",
+                    },
+                },
+                "transfers": {
+                    "fs": {"mod": "filesystem", "cls": "FileSystemTransferManager"},
+                    "gd": {"mod": "googledrive", "cls": "GoogleDriveTransferManager"},
+                },
+                "bar": {"slim": {"mod": "slimbar", "cls": "SlimBarManager"}},
+            },
+            f,
+        )
+    return path
+
+
+# What main.py imports and builds before the first transfer, bars included.
+IMPORTS = """
+import sys, time
+start = time.time()
+import main
+from speedclone.bar.commonbar import CommonBarManager
+from speedclone.bar.slimbar import SlimBarManager
+CommonBarManager.get_bar_manager()
+SlimBarManager.get_bar_manager()
+print(time.time() - start, "tqdm" in sys.modules)
+"""
+
+
+def run_imports():
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORTS],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    print(
+        "imports  {:>7.3f} s  tqdm loaded {}".format(float(out[0]), out[1]),
+        flush=True,
+    )
+
+
+def run_child(conf, port):
+    # Runs main.py against the fake server.
+    from speedclone.client.google import FileSystemTokenBackend, GoogleDrive
+
+    base = "http://127.0.0.1:{}".format(port)
+    GoogleDrive.drive_url = base + "/drive/v3/files"
+    GoogleDrive.drive_upload_url = base + "/upload/drive/v3/files"
+    FileSystemTokenBackend.token_url = base + "/token"
+
+    sys.argv = [
+        "main.py",
+        "--conf",
+        conf,
+        "--bar",
+        "slim",
+        "--daily-quota",
+        "0",
+        "s:/src",
+        "d:/bench",
+    ]
+    from main import main
+
+    main()
+
+
+def run(root, count, port):
+    accounts = make_accounts(root, count)
+    conf = make_conf(root, accounts)
+
+    FakeGoogle.first_byte = None
+    start = time.time()
+    subprocess.run(
+        [sys.executable, __file__, "--run", conf, "--port", str(port)],
+        cwd=root,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    elapsed = time.time() - start
+    print(
+        "{:>6} accounts  first byte {:>7.3f} s  total {:>7.3f} s".format(
+            count, FakeGoogle.first_byte - start, elapsed
+        ),
+        flush=True,
+    )
+    shutil.rmtree(accounts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", default="10,2000", help="Comma separated.")
+    parser.add_argument("--files", default=20, type=int)
+    parser.add_argument("--latency", default=0.01, type=float)
+    parser.add_argument("--port", default=8766, type=int)
+    parser.add_argument("--run", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_child(args.run, args.port)
+        return
+
+    FakeGoogle.latency = args.latency
+    ThreadingHTTPServer.daemon_threads = True
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeGoogle)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    run_imports()
+
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, "src"))
+    for i in range(args.files):
+        with open(os.path.join(root, "src", "file{:04d}.bin".format(i)), "wb") as f:
+            f.write(os.urandom(4096))
+
+    for count in args.accounts.split(","):
+        run(root, int(count), args.port)
+
+    shutil.rmtree(root)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
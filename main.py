@@ -1,9 +1,12 @@
 import importlib
 
+from speedclone.aio import AsyncTransferManager, import_aiohttp
 from speedclone.args import parse_args
+from speedclone.journal import Journal
 from speedclone.manager import TransferManager
+from speedclone.shard import ShardedTransferManager
+from speedclone.transfers import load_transfer
 
-TRANSFERS_BASE_IMPORT_PATH = "speedclone.transfers."
 BARS_BASE_IMPORT_PATH = "speedclone.bar."
 
 
@@ -41,30 +44,47 @@ def main():
             "Copy mode only support Google Drive, please check your config."
         )
 
-    f_trans = transfers.get(f_trans_name)
-    t_trans = transfers.get(t_trans_name)
-    from_transfer = getattr(
-        importlib.import_module(TRANSFERS_BASE_IMPORT_PATH + f_trans.get("mod")),
-        f_trans.get("cls"),
-    ).get_transfer(f_conf, f_path, args)
-
-    to_transfer = getattr(
-        importlib.import_module(TRANSFERS_BASE_IMPORT_PATH + t_trans.get("mod")),
-        t_trans.get("cls"),
-    ).get_transfer(t_conf, t_path, args)
+    from_transfer = load_transfer(transfers, f_conf, f_path, args)
 
     bar = bars.get(args.bar)
     bar_manager = getattr(
         importlib.import_module(BARS_BASE_IMPORT_PATH + bar.get("mod")), bar.get("cls"),
     ).get_bar_manager()
 
-    transfer_manager = TransferManager(
-        download_manager=from_transfer,
-        upload_manager=to_transfer,
-        bar_manager=bar_manager,
-        sleep_time=args.interval,
-        max_workers=args.workers,
-    )
+    journal = Journal(args.journal, f, t) if args.journal else None
+
+    if args.engine == "asyncio":
+        import_aiohttp()
+
+    to_transfer = load_transfer(transfers, t_conf, t_path, args)
+
+    if args.processes > 1:
+        transfer_manager = ShardedTransferManager(
+            download_manager=from_transfer,
+            upload_manager=to_transfer,
+            bar_manager=bar_manager,
+            processes=args.processes,
+            setup=(f_conf, f_path, t_conf, t_path, transfers, args),
+            journal=journal,
+            max_queue=args.queue_size,
+        )
+    else:
+        manager_cls = TransferManager
+        if args.engine == "asyncio":
+            manager_cls = AsyncTransferManager
+
+        transfer_manager = manager_cls(
+            download_manager=from_transfer,
+            upload_manager=to_transfer,
+            bar_manager=bar_manager,
+            sleep_time=args.interval,
+            max_workers=args.workers,
+            journal=journal,
+            max_queue=args.queue_size,
+            large_threshold=args.large_threshold,
+            large_workers=args.large_workers,
+            stats_interval=args.stats,
+        )
     transfer_manager.run()
 
 
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import ssl
+from concurrent.futures import Future
+
+from requests.exceptions import HTTPError
+
+from .manager import TransferManager
+from .session import PooledSession
+
+
+def import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise Exception(
+            "The asyncio engine needs aiohttp, install it with `pip install aiohttp`."
+        )
+    return aiohttp
+
+
+class AsyncResponse:
+    # The parts of a requests response the transfers read.
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError(
+                "{} Error for url: {}".format(self.status_code, self.url),
+                response=self,
+            )
+
+
+class AsyncSession:
+    # aiohttp counterpart of PooledSession, taking the same `http` options.
+    # One session per client is shared by all its transfers on the loop.
+    def __init__(self, http=None):
+        aiohttp = import_aiohttp()
+        http = http or {}
+        pool = http.get("pool", {})
+
+        verify = http.get("verify", True)
+        if verify is False:
+            context = False
+        else:
+            context = ssl.create_default_context(
+                cafile=verify if isinstance(verify, str) else None
+            )
+            cert = http.get("cert")
+            if cert:
+                context.load_cert_chain(*([cert] if isinstance(cert, str) else cert))
+
+        connector = aiohttp.TCPConnector(
+            limit=pool.get("maxsize", PooledSession.pool_maxsize), ssl=context
+        )
+        self.proxy = http.get("proxies", {}).get("https")
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers=http.get("headers", {})
+        )
+
+    async def request(self, method, url, params=None, **kwargs):
+        if params:
+            params = {k: str(v) for k, v in params.items()}
+        async with self.session.request(
+            method, url, params=params, proxy=self.proxy, **kwargs
+        ) as r:
+            content = await r.read()
+            return AsyncResponse(str(r.url), r.status, r.headers, content)
+
+    async def close(self):
+        await self.session.close()
+
+
+class AsyncTransferManager(TransferManager):
+    # Runs transfers as coroutines on one event loop, so thousands of them
+    # can be in flight without a thread each. Destinations that provide
+    # `get_async_worker` transfer on the loop, every other worker runs on the
+    # thread pool as before.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.wakeup = None
+
+    def notify(self):
+        super().notify()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def run_worker(self, executor, task):
+        loop = asyncio.get_running_loop()
+        get_async_worker = getattr(self.upload_manager, "get_async_worker", None)
+        worker = None
+        if get_async_worker:
+            # Picking a client may load its credentials and read the quota
+            # ledger, neither of which may block the loop.
+            worker = await loop.run_in_executor(executor, get_async_worker, task)
+        if worker is None:
+            return await loop.run_in_executor(executor, self.get_worker(task))
+        return await worker(self.bar_manager.get_bar(task))
+
+    async def run_task(self, executor, task, slot):
+        # Settle a Future like the thread pool would, so the callbacks are
+        # shared with the thread engine.
+        future = Future()
+        try:
+            result = await self.run_worker(executor, task)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            self.release_worker(slot, future)
+            self.done_callback(future, task=task)
+
+    async def dispatch(self, executor):
+        with self.cond:
+            self.loop = asyncio.get_running_loop()
+            self.wakeup = asyncio.Event()
+
+        tasks = set()
+        try:
+            while True:
+                self.wakeup.clear()
+                with self.cond:
+                    if self.finished():
+                        break
+                    taken = self.take_task()
+                if not taken:
+                    await self.wakeup.wait()
+                    continue
+
+                t = asyncio.ensure_future(self.run_task(executor, *taken))
+                tasks.add(t)
+                t.add_done_callback(tasks.discard)
+                if self.sleep_time:
+                    await asyncio.sleep(self.sleep_time)
+        finally:
+            with self.cond:
+                self.loop = None
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            close = getattr(self.upload_manager, "close_async", None)
+            if close:
+                await close()
+
+    def add_to_excutor(self, executor):
+        asyncio.run(self.dispatch(executor))
@@ -16,6 +16,52 @@ def parse_args():
         help="Interval time when putting workers into thread pool.",
     )
     parser.add_argument("--workers", default=5, type=int, help="The number of workers.")
+    parser.add_argument(
+        "--engine",
+        default="thread",
+        choices=("thread", "asyncio"),
+        help="Run transfers on threads, or as coroutines on one event loop "
+        "(needs aiohttp).",
+    )
+    parser.add_argument(
+        "--async-max-size",
+        default=4 * (1024 ** 2),
+        type=int,
+        help="Largest file the asyncio engine uploads in one request on the "
+        "event loop, bigger ones use thread workers.",
+    )
+    parser.add_argument(
+        "--async-memory",
+        default=256 * (1024 ** 2),
+        type=int,
+        help="Bytes of file content the asyncio engine may hold at once.",
+    )
+    parser.add_argument(
+        "--processes",
+        default=1,
+        type=int,
+        help="Number of worker processes, each with --workers workers and its "
+        "own share of the accounts.",
+    )
+    parser.add_argument(
+        "--large-threshold",
+        default=0,
+        type=int,
+        help="Files of at least this size run in the large lane, 0 disables "
+        "the lanes.",
+    )
+    parser.add_argument(
+        "--large-workers",
+        default=2,
+        type=int,
+        help="The number of workers of the large lane, 0 disables the lanes.",
+    )
+    parser.add_argument(
+        "--queue-size",
+        default=1000,
+        type=int,
+        help="Max number of listed files waiting for a worker.",
+    )
     parser.add_argument(
         "--bar", default="common", type=str, help="Name of the progress bar."
     )
@@ -26,17 +72,73 @@ def parse_args():
         type=str,
         help="Path to the config file.",
     )
+    parser.add_argument(
+        "--journal",
+        default=None,
+        type=str,
+        help="Path to the journal file used to skip finished files on rerun.",
+    )
+    parser.add_argument(
+        "--stats",
+        default=0,
+        type=int,
+        help="Print a line of transfer, connection and client counters every "
+        "this many seconds and at exit, 0 disables it.",
+    )
     parser.add_argument(
         "--sleep",
         default=0,
         type=int,
         help="Time to sleep when client has been throttled.",
     )
+    parser.add_argument(
+        "--rate",
+        default=10,
+        type=float,
+        help="Initial requests per second of each client.",
+    )
+    parser.add_argument(
+        "--max-rate",
+        default=100,
+        type=float,
+        help="Highest requests per second a client may reach.",
+    )
+    parser.add_argument(
+        "--daily-quota",
+        default=750 * 1000 ** 3,
+        type=int,
+        help="Bytes each Google Drive account may upload in 24 hours, 0 disables "
+        "the accounting.",
+    )
+    parser.add_argument(
+        "--token-margin",
+        default=300,
+        type=int,
+        help="Seconds before expiry the tokens of busy accounts are renewed in "
+        "the background, 0 renews them only when expired.",
+    )
     parser.add_argument(
         "--copy",
         action="store_true",
         help="Copy file through drive, can only use with Google Drive.",
     )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Transfer files whose destination differs in size, checksum or "
+        "modified time instead of skipping every existing file.",
+    )
+    parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="Replace changed files in place when syncing.",
+    )
+    parser.add_argument(
+        "--copy-batch-size",
+        default=100,
+        type=int,
+        help="Number of copies sent in one batch request in copy mode.",
+    )
     parser.add_argument(
         "--step-size",
         default=1024 ** 2,
@@ -49,9 +151,19 @@ def parse_args():
         type=int,
         help="Size of single request in multiple chunk uploading.",
     )
-
-
+    parser.add_argument(
+        "--prefetch",
+        default=1,
+        type=int,
+        help="Number of chunks to read ahead from the source while uploading.",
+    )
 
+    parser.add_argument(
+        "--download-connections",
+        default=1,
+        type=int,
+        help="Number of parallel ranged connections when downloading a file.",
+    )
     parser.add_argument(
         "--max-page-size",
         default=100,
@@ -59,6 +171,34 @@ def parse_args():
         help="Max size of single page when listing files.",
     )
 
+    parser.add_argument(
+        "--list-workers",
+        default=4,
+        type=int,
+        help="Number of folders listed at the same time.",
+    )
+    parser.add_argument(
+        "--list-retries",
+        default=3,
+        type=int,
+        help="Times to retry listing a page before skipping it.",
+    )
+    parser.add_argument(
+        "--index-folders",
+        default=100,
+        type=int,
+        help="Number of destination folders whose listing is kept in memory.",
+    )
+    parser.add_argument(
+        "--index-max-files",
+        default=10000,
+        type=int,
+        help="Folders with more files than this are checked file by file.",
+    )
+
+    # Set in worker processes to pick their share of the accounts.
+    parser.set_defaults(shard=None)
+
     args, rest = parser.parse_known_args()
 
     if os.path.exists(args.conf):
@@ -1,4 +1,3 @@
-from tqdm.autonotebook import tqdm
 from .basebar import BaseBarManager
 
 
@@ -29,6 +28,9 @@ class CommonBar:
         self.step += 1
 
     def _create_bar(self, total):
+        # tqdm is slow to import, leave it until the first transfer starts.
+        from tqdm.autonotebook import tqdm
+
         bar_format = "| {desc} | {percentage: >6.2f}% |{bar:20}| {n_fmt:>6} / {total_fmt:<6} [{rate_fmt:<8} {elapsed}>{remaining}]"
         bar = tqdm(
             total=total,
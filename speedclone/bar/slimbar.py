@@ -1,9 +1,11 @@
-from tqdm.autonotebook import tqdm
 from .basebar import BaseBarManager
 
 
 class SlimBar:
     def __init__(self):
+        # tqdm is slow to import, leave it until the first transfer starts.
+        from tqdm.autonotebook import tqdm
+
         self.byte_bar = tqdm(
             total=0, position=1, unit="B", unit_scale=True, unit_divisor=1024
         )
@@ -29,7 +31,13 @@ class SlimBar:
 
 class SlimBarManager(BaseBarManager):
     def __init__(self):
-        self.bar = SlimBar()
+        self._bar = None
+
+    @property
+    def bar(self):
+        if self._bar is None:
+            self._bar = SlimBar()
+        return self._bar
 
     def update_total(self, task):
         self.bar.update_total(self.bar.byte_bar, task.get_total())
@@ -52,4 +60,5 @@ class SlimBarManager(BaseBarManager):
         self.update(e.task)
 
     def exit(self):
-        self.bar.close_bar()
+        if self._bar is not None:
+            self._bar.close_bar()
@@ -0,0 +1,201 @@
+from queue import Queue
+from threading import Event, Lock, Semaphore, Thread, local
+
+
+class BufferStats:
+    def __init__(self):
+        self.lock = Lock()
+        self.allocations = 0
+        self.copies = 0
+        self.chunks = 0
+
+    def record(self, chunks=0, copies=0, allocations=0):
+        with self.lock:
+            self.chunks += chunks
+            self.copies += copies
+            self.allocations += allocations
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "chunks": self.chunks,
+                "copies": self.copies,
+                "allocations": self.allocations,
+                "copies_per_chunk": self.copies / self.chunks if self.chunks else 0,
+            }
+
+
+buffer_stats = BufferStats()
+
+
+class BufferPool:
+    max_free = 32
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = Lock()
+        self.free = []
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        buffer_stats.record(allocations=1)
+        return bytearray(self.size)
+
+    def release(self, buf):
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buf)
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+class HeldBuffers:
+    # Pooled buffers whose views a prefetch consumer may still hold. They go
+    # back to their pool once the consumer is done.
+    def __init__(self):
+        self.lock = Lock()
+        self.items = []
+        self.done = False
+
+    def hold(self, pool, bufs):
+        with self.lock:
+            if not self.done:
+                self.items.extend((pool, buf) for buf in bufs)
+                return
+        for buf in bufs:
+            pool.release(buf)
+
+    def release(self):
+        with self.lock:
+            self.done = True
+            items, self.items = self.items, []
+        for pool, buf in items:
+            pool.release(buf)
+
+
+# Set on prefetch producer threads.
+_producer = local()
+
+
+def get_pool(size):
+    with _pools_lock:
+        pool = _pools.get(size)
+        if pool is None:
+            pool = _pools[size] = BufferPool(size)
+        return pool
+
+
+def readinto_full(f, view):
+    filled = 0
+    while filled < len(view):
+        n = f.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def iter_readinto(f, chunk_size, buffers=1):
+    # Chunks are views on pooled buffers; a view stays valid until the
+    # generator has been advanced `buffers` more times.
+    pool = get_pool(chunk_size)
+    ring = []
+    try:
+        i = 0
+        while True:
+            if len(ring) < buffers:
+                ring.append(pool.acquire())
+            view = memoryview(ring[i % buffers])
+            n = readinto_full(f, view)
+            if not n:
+                return
+            buffer_stats.record(chunks=1, copies=1)
+            yield view[:n]
+            i += 1
+    finally:
+        held = getattr(_producer, "held", None)
+        if held is not None:
+            held.hold(pool, ring)
+        else:
+            for buf in ring:
+                pool.release(buf)
+
+
+def iter_chunks(chunks):
+    for chunk in chunks:
+        if chunk:
+            buffer_stats.record(chunks=1, copies=1, allocations=1)
+            yield memoryview(chunk)
+
+
+def skip_chunks(chunks, n):
+    # Drop the first `n` bytes of a stream of memoryviews.
+    for chunk in chunks:
+        if n >= len(chunk):
+            n -= len(chunk)
+            continue
+        yield chunk[n:]
+        n = 0
+
+
+_END = object()
+_ERROR = object()
+
+
+def prefetch(iterable, depth=1):
+    # Pull items from `iterable` on a producer thread while the caller is
+    # still busy with the previous one. At most `depth + 1` items are alive
+    # at a time: the one held by the caller and the ones read ahead.
+    if depth <= 0:
+        yield from iterable
+        return
+
+    slots = Semaphore(depth + 1)
+    items = Queue()
+    stopped = Event()
+    held = HeldBuffers()
+
+    def producer():
+        # The source reaches its end here while the caller still reads the
+        # last chunks, their buffers must not be reused until it is done.
+        _producer.held = held
+        it = iter(iterable)
+        try:
+            while True:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                try:
+                    item = next(it)
+                except StopIteration:
+                    items.put((_END, None))
+                    return
+                if stopped.is_set():
+                    return
+                items.put((None, item))
+        except Exception as e:
+            items.put((_ERROR, e))
+        finally:
+            close = getattr(it, "close", None)
+            if close:
+                close()
+
+    Thread(target=producer, daemon=True).start()
+
+    try:
+        while True:
+            kind, item = items.get()
+            if kind is _END:
+                return
+            if kind is _ERROR:
+                raise item
+            yield item
+            slots.release()
+    finally:
+        stopped.set()
+        slots.release(depth + 1)
+        held.release()
@@ -0,0 +1,287 @@
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+
+class DirCache:
+    def __init__(self, root, db_path=None, drive_id=None):
+        self.root = root
+        self.db_path = db_path
+        self.drive_id = drive_id or ""
+        self.lock = Lock()
+        self.conn = None
+        self.dirs = {"": root}
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.db_path, check_same_thread=False, isolation_level=None
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS dirs ("
+                "drive_id TEXT, root TEXT, path TEXT, dir_id TEXT, "
+                "PRIMARY KEY (drive_id, root, path))"
+            )
+        return self.conn
+
+    def get(self, path):
+        with self.lock:
+            dir_id = self.dirs.get(path)
+            if dir_id or not self.db_path:
+                return dir_id
+
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT dir_id FROM dirs WHERE drive_id = ? AND root = ? "
+                    "AND path = ?",
+                    (self.drive_id, self.root, path),
+                )
+                .fetchone()
+            )
+            if row:
+                self.dirs[path] = row[0]
+                return row[0]
+
+    def __getitem__(self, path):
+        dir_id = self.get(path)
+        if dir_id is None:
+            raise KeyError(path)
+        return dir_id
+
+    def __setitem__(self, path, dir_id):
+        with self.lock:
+            self.dirs[path] = dir_id
+            if self.db_path:
+                self._connect().execute(
+                    "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+                    (self.drive_id, self.root, path, dir_id),
+                )
+
+    def pop(self, path):
+        # Drop a stale folder together with everything cached below it.
+        if not path:
+            return
+        prefix = path + "/"
+        with self.lock:
+            for p in [p for p in self.dirs if p == path or p.startswith(prefix)]:
+                del self.dirs[p]
+            if self.db_path:
+                self._connect().execute(
+                    "DELETE FROM dirs WHERE drive_id = ? AND root = ? "
+                    "AND (path = ? OR substr(path, 1, ?) = ?)",
+                    (self.drive_id, self.root, path, len(prefix), prefix),
+                )
+
+
+class FolderIndex:
+    # LRU of folder_id -> {name: file}. A folder whose listing does not fit
+    # in `max_files` is stored as None and must be queried per file.
+    def __init__(self, list_folder, max_folders=100, max_files=10000):
+        self.list_folder = list_folder
+        self.max_folders = max_folders
+        self.max_files = max_files
+        self.lock = Lock()
+        self.folders = OrderedDict()
+        self.loading = {}
+
+    def _load(self, folder_id):
+        with self.lock:
+            if folder_id in self.folders:
+                self.folders.move_to_end(folder_id)
+                return self.folders[folder_id]
+            future = self.loading.get(folder_id)
+            owner = future is None
+            if owner:
+                future = self.loading[folder_id] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            files = self.list_folder(folder_id, self.max_files)
+        except Exception as e:
+            with self.lock:
+                self.loading.pop(folder_id, None)
+            future.set_exception(e)
+            raise
+
+        self._store(folder_id, files)
+        future.set_result(files)
+        return files
+
+    def _store(self, folder_id, files):
+        with self.lock:
+            self.loading.pop(folder_id, None)
+            self.folders[folder_id] = files
+            while len(self.folders) > self.max_folders:
+                self.folders.popitem(last=False)
+
+    def get(self, folder_id):
+        if self.max_folders <= 0:
+            return None
+        return self._load(folder_id)
+
+    def peek(self, folder_id):
+        # The cached listing, or None without loading anything.
+        with self.lock:
+            return self.folders.get(folder_id)
+
+    def seed(self, folder_id):
+        # A folder we just created is known to be empty.
+        if self.max_folders > 0:
+            self._store(folder_id, {})
+
+    def add(self, folder_id, name, file):
+        with self.lock:
+            files = self.folders.get(folder_id)
+            if files is not None:
+                files[name] = file
+
+    def pop(self, folder_id):
+        with self.lock:
+            self.folders.pop(folder_id, None)
+
+
+class ListingSnapshot:
+    # Files and folders below one source folder, current as of the Drive
+    # changes cursor stored with them. Folders are kept in memory to turn a
+    # parent chain back into a path. Folders found by a replay stay pending
+    # until the cursor moves past it, so an interrupted replay crawls them
+    # again.
+    def __init__(self, db_path, drive_id, root_id):
+        self.key = "{}:{}".format(drive_id or "", root_id)
+        self.root_id = root_id
+        self.lock = Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cursors ("
+                "key TEXT PRIMARY KEY, page_token TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS nodes ("
+                "key TEXT, id TEXT, parent_id TEXT, name TEXT, folder INTEGER, "
+                "size INTEGER, md5 TEXT, mtime TEXT, PRIMARY KEY (key, id))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS pending ("
+                "key TEXT, id TEXT, PRIMARY KEY (key, id))"
+            )
+        self.folders = {
+            row[0]: (row[1], row[2])
+            for row in self.conn.execute(
+                "SELECT id, parent_id, name FROM nodes WHERE key = ? AND folder = 1",
+                (self.key,),
+            )
+        }
+
+    def get_token(self):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT page_token FROM cursors WHERE key = ?", (self.key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_token(self, page_token):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cursors VALUES (?, ?)", (self.key, page_token)
+            )
+            self.conn.execute("DELETE FROM pending WHERE key = ?", (self.key,))
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM cursors WHERE key = ?", (self.key,))
+            self.conn.execute("DELETE FROM nodes WHERE key = ?", (self.key,))
+            self.conn.execute("DELETE FROM pending WHERE key = ?", (self.key,))
+            self.folders.clear()
+
+    def get_pending(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM pending WHERE key = ?", (self.key,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def add_pending(self, ids):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO pending VALUES (?, ?)",
+                [(self.key, i) for i in ids],
+            )
+
+    def add(self, nodes):
+        # `nodes` are (id, parent_id, name, folder, size, md5, mtime) tuples.
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(self.key,) + tuple(node) for node in nodes],
+            )
+            for node in nodes:
+                if node[3]:
+                    self.folders[node[0]] = (node[1], node[2])
+
+    def remove(self, ids):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM nodes WHERE key = ? AND id = ?",
+                [(self.key, i) for i in ids],
+            )
+            for i in ids:
+                self.folders.pop(i, None)
+
+    def set_folder(self, folder_id, parent_id, name):
+        self.folders[folder_id] = (parent_id, name)
+
+    def path(self, folder_id):
+        # Path of a folder relative to the root, None if it is not below it.
+        names = []
+        while folder_id != self.root_id:
+            node = self.folders.get(folder_id)
+            if node is None or len(names) > len(self.folders):
+                return None
+            folder_id, name = node
+            names.append(name)
+        return "/".join(reversed(names))
+
+
+class TokenCache:
+    # Service account access tokens by account, so a restart reuses the ones
+    # still valid instead of signing in every account again.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = Lock()
+        self.conn = None
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.db_path, check_same_thread=False, isolation_level=None, timeout=30
+            )
+            # Same secrets as the token files.
+            os.chmod(self.db_path, 0o600)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                "account TEXT PRIMARY KEY, token TEXT)"
+            )
+        return self.conn
+
+    def get(self, account):
+        with self.lock:
+            row = (
+                self._connect()
+                .execute("SELECT token FROM tokens WHERE account = ?", (account,))
+                .fetchone()
+            )
+            return json.loads(row[0]) if row else None
+
+    def set(self, account, token):
+        with self.lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO tokens VALUES (?, ?)",
+                (account, json.dumps(token)),
+            )
@@ -1,24 +1,35 @@
+import asyncio
 import json
 import os
+import re
 import time
-from threading import Lock, Thread
+import uuid
+from threading import Lock
+from urllib.parse import urlencode
 
-import jwt
-import requests
+from ..aio import AsyncSession
+from ..ratelimit import RateLimiter, parse_retry_after
+from ..session import PooledSession
+from ..utils import format_time
 
 
 class FileSystemTokenBackend:
     token_url = "https://oauth2.googleapis.com/token"
-    http = {}
-    lock = Lock()
+    session = None
 
     def __init__(self, token_path, cred):
         self.token_path = token_path
+        self.account = token_path
         self.client = cred
+        self.lock = Lock()
+        self.used = False
+        self.token = None
 
+    def _load_token(self):
+        # Read on first use, so starting does not open every account's file.
         if os.path.exists(self.token_path):
             with open(self.token_path, "r") as f:
-                self.token = json.load(f)
+                return json.load(f)
         else:
             raise Exception("No token file found.")
 
@@ -26,31 +37,42 @@ class FileSystemTokenBackend:
         with open(self.token_path, "w") as f:
             json.dump(self.token, f)
 
-    def _token_expired(self):
-        if self.token:
-            expired_time = self.token.get("expires_in") + self.token.get("get_time", 0)
-            return expired_time <= int(time.time())
-        else:
-            return True
+    def get_expire_time(self):
+        if not self.token:
+            return 0
+        return self.token.get("expires_in", 0) + self.token.get("get_time", 0)
 
-    def _refresh_accesstoken(self):
+    def _token_expired(self, margin=0):
+        return self.get_expire_time() - margin <= int(time.time())
+
+    def refresh(self, margin=0):
+        # Unless the token is still good for `margin` seconds, e.g. because
+        # another thread just renewed it.
         with self.lock:
-            now_time = int(time.time())
-            refresh_token = self.token.get("refresh_token")
+            if self.token is None:
+                self.token = self._load_token()
+            if self._token_expired(margin):
+                self._refresh_accesstoken()
+                self.used = False
+
+    def _refresh_accesstoken(self):
+        now_time = int(time.time())
+        refresh_token = self.token.get("refresh_token")
 
-            data = {"refresh_token": refresh_token, "grant_type": "refresh_token"}
-            data.update(self.client)
+        data = {"refresh_token": refresh_token, "grant_type": "refresh_token"}
+        data.update(self.client)
 
-            r = requests.post(self.token_url, data=data, **self.http)
-            r.raise_for_status()
+        r = self.session.post(self.token_url, data=data)
+        r.raise_for_status()
 
-            self.token = r.json()
-            self.token["get_time"] = now_time
-            self._update_tokenfile()
+        self.token = r.json()
+        self.token["get_time"] = now_time
+        self._update_tokenfile()
 
     def get_token(self):
+        self.used = True
         if self._token_expired():
-            self._refresh_accesstoken()
+            self.refresh()
         return self.token.get("access_token")
 
 
@@ -58,61 +80,101 @@ class FileSystemServiceAccountTokenBackend(FileSystemTokenBackend):
     scope = "https://www.googleapis.com/auth/drive"
     expires_in = 3600
 
-    def __init__(self, cred_path):
+    def __init__(self, cred_path, cache=None):
         self.cred_path = cred_path
-        self.token = {}
+        self.cache = cache
+        self.config = None
+        self.token = None
         self.lock = Lock()
-
-        if os.path.exists(self.cred_path):
-            with open(self.cred_path, "r") as f:
-                self.config = json.load(f)
-        else:
-            raise Exception("No cred file found.")
+        self.used = False
+
+    def _get_config(self):
+        if self.config is None:
+            if os.path.exists(self.cred_path):
+                with open(self.cred_path, "r") as f:
+                    self.config = json.load(f)
+            else:
+                raise Exception("No cred file found.")
+        return self.config
+
+    @property
+    def account(self):
+        return self._get_config().get("client_email", self.cred_path)
+
+    def _load_token(self):
+        if self.cache:
+            return self.cache.get(self.account) or {}
+        return {}
 
     def _refresh_accesstoken(self):
-        with self.lock:
-            now_time = int(time.time())
-            token_data = {
-                "iss": self.config["client_email"],
-                "scope": self.scope,
-                "aud": self.token_url,
-                "exp": now_time + self.expires_in,
-                "iat": now_time,
-            }
-
-            auth_jwt = jwt.encode(
-                token_data,
-                self.config["private_key"].encode("utf-8"),
-                algorithm="RS256",
-            )
-            data = {
-                "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
-                "assertion": auth_jwt,
-            }
-            r = requests.post(self.token_url, data=data, **self.http)
-            r.raise_for_status()
-            self.token = r.json()
-            self.token["get_time"] = now_time
+        # jwt is slow to import and only service accounts sign.
+        import jwt
+
+        config = self._get_config()
+        now_time = int(time.time())
+        token_data = {
+            "iss": config["client_email"],
+            "scope": self.scope,
+            "aud": self.token_url,
+            "exp": now_time + self.expires_in,
+            "iat": now_time,
+        }
+
+        auth_jwt = jwt.encode(
+            token_data,
+            config["private_key"].encode("utf-8"),
+            algorithm="RS256",
+        )
+        data = {
+            "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+            "assertion": auth_jwt,
+        }
+        r = self.session.post(self.token_url, data=data)
+        r.raise_for_status()
+        self.token = r.json()
+        self.token["get_time"] = now_time
+        if self.cache:
+            self.cache.set(self.account, self.token)
 
 
 class GoogleDrive:
 
     drive_url = "https://www.googleapis.com/drive/v3/files"
     drive_upload_url = "https://www.googleapis.com/upload/drive/v3/files"
+    changes_url = "https://www.googleapis.com/drive/v3/changes"
+    batch_url = "https://www.googleapis.com/batch/drive/v3"
+    batch_path = "/drive/v3/files"
+    # What uploads and copies return, enough to compare the file with --sync.
+    file_fields = "id, name, size, md5Checksum, modifiedTime"
     sleep_time = 10
     http = {}
 
     def __init__(self, token_backend, drive=None):
         self.token_backend = token_backend
         self.drive = drive
-        self.sleeping = False
+        self._session = None
+        self.session_lock = Lock()
+        self.async_session = None
+        self.limiter = RateLimiter()
+
+    @property
+    def account(self):
+        return getattr(self.token_backend, "account", None)
+
+    @property
+    def session(self):
+        # Created on first request, most of a large account set starts idle.
+        if self._session is None:
+            with self.session_lock:
+                if self._session is None:
+                    self._session = PooledSession(self.http)
+        return self._session
 
     def get_headers(self, content_type="application/json"):
         headers = {
             "Authorization": "Bearer {}".format(self.token_backend.get_token()),
             "Content-Type": content_type,
         }
-        headers.update(self.http.get("headers", {}))
         return headers
 
     def get_params(self, params={}):
@@ -133,18 +195,43 @@ class GoogleDrive:
         params = {"supportsAllDrives": "true"}
         data = {"name": name, "parents": [parent_id], "mimeType": mime}
         headers = self.get_headers()
-        r = requests.post(
-            self.drive_url, headers=headers, params=params, json=data, **self.http
+        r = self.request(
+            "POST", self.drive_url, headers=headers, params=params, json=data
         )
         return r
 
     def get_files_by_p(self, params):
         headers = self.get_headers()
-        r = requests.get(
-            self.drive_url, headers=headers, params=self.get_params(params), **self.http
+        r = self.request(
+            "GET", self.drive_url, headers=headers, params=self.get_params(params)
+        )
+        return r
+
+    def get_start_page_token(self):
+        params = {"supportsAllDrives": "true"}
+        if self.drive:
+            params.update({"driveId": self.drive})
+        headers = self.get_headers()
+        r = self.request(
+            "GET", self.changes_url + "/startPageToken", headers=headers, params=params
         )
         return r
 
+    def get_changes(self, page_token, fields, page_size=1000):
+        params = {
+            "pageToken": page_token,
+            "pageSize": page_size,
+            "fields": fields,
+            "includeRemoved": "true",
+            "supportsAllDrives": "true",
+            "includeItemsFromAllDrives": "true",
+        }
+        if self.drive:
+            params.update({"driveId": self.drive})
+        headers = self.get_headers()
+        r = self.request("GET", self.changes_url, headers=headers, params=params)
+        return r
+
     def get_files_by_name(
         self,
         parent_id,
@@ -170,78 +257,224 @@ class GoogleDrive:
         r = self.get_files_by_p(p)
         return r
 
-    def get_upload_url(self, parent_id, name):
+    def file_exists(self, parent_id, name):
         exist_file = (
             self.get_files_by_name(parent_id, name, mime="file", fields=("files/kind",))
             .json()
             .get("files", [])
         )
-        if exist_file:
+        return bool(exist_file)
+
+    def get_upload_url(self, parent_id, name, check=True, file_id=None, mtime=None):
+        if check and self.file_exists(parent_id, name):
             return False
 
-        params = {"uploadType": "resumable", "supportsAllDrives": "true"}
+        params = {
+            "uploadType": "resumable",
+            "supportsAllDrives": "true",
+            "fields": self.file_fields,
+        }
         headers = self.get_headers()
-        data = {"name": name, "parents": [parent_id]}
-        r = requests.post(
-            self.drive_upload_url,
-            headers=headers,
-            json=data,
-            params=params,
-            **self.http
+        data = {}
+        if mtime:
+            data.update({"modifiedTime": format_time(mtime)})
+
+        if file_id:
+            # Upload a new revision of an existing file.
+            r = self.request(
+                "PATCH",
+                self.drive_upload_url + "/" + file_id,
+                headers=headers,
+                json=data,
+                params=params,
+            )
+        else:
+            data.update({"name": name, "parents": [parent_id]})
+            r = self.request(
+                "POST", self.drive_upload_url, headers=headers, json=data, params=params
+            )
+        return r
+
+    def get_multipart_body(self, parent_id, name, size, file_id=None, mtime=None):
+        # Body of a multipart upload of metadata and content, for small files.
+        # Returns the boundary, the body and a view on its `size` bytes left
+        # for the content.
+        metadata = {}
+        if mtime:
+            metadata.update({"modifiedTime": format_time(mtime)})
+        if not file_id:
+            metadata.update({"name": name, "parents": [parent_id]})
+
+        boundary = "upload_" + uuid.uuid4().hex
+        head = (
+            "--{boundary}\r\n"
+            "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+            "{metadata}\r\n"
+            "--{boundary}\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n".format(
+                boundary=boundary, metadata=json.dumps(metadata)
+            )
+        )
+        head = head.encode()
+        tail = "\r\n--{}--\r\n".format(boundary).encode()
+        body = bytearray(len(head) + size + len(tail))
+        body[: len(head)] = head
+        body[len(head) + size :] = tail
+        return boundary, body, memoryview(body)[len(head) : len(head) + size]
+
+    async def upload_async(self, boundary, body, file_id=None):
+        params = {
+            "uploadType": "multipart",
+            "supportsAllDrives": "true",
+            "fields": self.file_fields,
+        }
+        # Renewing the token is a blocking request, keep it off the loop.
+        headers = await asyncio.to_thread(
+            self.get_headers, "multipart/related; boundary={}".format(boundary)
+        )
+        if file_id:
+            method, url = "PATCH", self.drive_upload_url + "/" + file_id
+        else:
+            method, url = "POST", self.drive_upload_url
+        r = await self.request_async(
+            method, url, headers=headers, params=params, data=body
         )
         return r
 
     def get_file(self, file_id, fields):
         params = {"fields": fields, "supportsAllDrives": "true"}
         headers = self.get_headers()
-        r = requests.get(
-            self.drive_url + "/" + file_id, headers=headers, params=params, **self.http
+        r = self.request(
+            "GET", self.drive_url + "/" + file_id, headers=headers, params=params
         )
         return r
 
-    def get_download_request(self, file_id):
+    def get_download_request(self, file_id, headers=None):
         params = {"alt": "media", "supportsAllDrives": "true"}
-        headers = self.get_headers()
-        r = requests.get(
+        headers = {**self.get_headers(), **(headers or {})}
+        r = self.request(
+            "GET",
             self.drive_url + "/" + file_id,
             headers=headers,
             params=params,
             stream=True,
-            **self.http
         )
         return r
 
-    def copy_to(self, source_id, dest_id, name):
-        exist_file = (
-            self.get_files_by_name(dest_id, name, mime="file", fields=("files/kind",))
-            .json()
-            .get("files", [])
-        )
-        if exist_file:
+    def copy_to(self, source_id, dest_id, name, check=True):
+        if check and self.file_exists(dest_id, name):
             return False
 
-        params = {"supportsAllDrives": "true"}
+        params = {"supportsAllDrives": "true", "fields": self.file_fields}
         data = {"name": name, "parents": [dest_id]}
         headers = self.get_headers()
-        r = requests.post(
+        r = self.request(
+            "POST",
             self.drive_url + "/" + source_id + "/copy",
             headers=headers,
             json=data,
             params=params,
-            **self.http
         )
         return r
 
-    def sleep(self, seconds=None):
-        if not seconds:
-            seconds = self.sleep_time
-        if not self.sleeping:
+    def batch(self, requests):
+        # `requests` is a list of (method, path, params, data) relative to the
+        # files endpoint. Returns {index: (status_code, body)} of the replies.
+        boundary = "batch_" + uuid.uuid4().hex
+        parts = []
+        for i, (method, path, params, data) in enumerate(requests):
+            url = self.batch_path + "/" + path
+            if params:
+                url += "?" + urlencode(params)
+            parts.append(
+                "--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                "Content-ID: <item{i}>\r\n\r\n"
+                "{method} {url}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                "{data}\r\n".format(
+                    boundary=boundary,
+                    i=i,
+                    method=method,
+                    url=url,
+                    data=json.dumps(data),
+                )
+            )
+        body = "".join(parts) + "--{}--\r\n".format(boundary)
+
+        headers = self.get_headers(
+            content_type="multipart/mixed; boundary={}".format(boundary)
+        )
+        r = self.request("POST", self.batch_url, headers=headers, data=body.encode())
+        r.raise_for_status()
+        return self._parse_batch(r)
+
+    def _parse_batch(self, r):
+        boundary = re.search(r'boundary="?([^";]+)"?', r.headers["Content-Type"])
+        delimiter = "--" + boundary.group(1)
+        blank_line = re.compile(r"\r?\n\r?\n")
+
+        replies = {}
+        for part in r.content.decode("utf-8").split(delimiter):
+            # Each part: MIME headers, blank line, status line and headers of
+            # the sub response, blank line, body.
+            sections = blank_line.split(part.strip(), 2)
+            if len(sections) < 2:
+                continue
+            content_id = re.search(r"Content-ID:\s*<response-item(\d+)>", sections[0])
+            if not content_id:
+                continue
+
+            status_code = int(sections[1].split(None, 2)[1])
+            payload = sections[2].strip() if len(sections) > 2 else ""
+            try:
+                reply = json.loads(payload) if payload else {}
+            except ValueError:
+                reply = {"error": {"message": payload}}
+            replies[int(content_id.group(1))] = (status_code, reply)
+        return replies
+
+    @property
+    def sleeping(self):
+        return self.limiter.is_paused()
+
+    @staticmethod
+    def is_rate_limited(status_code, text):
+        # userRateLimitExceeded and rateLimitExceeded, of a response or of one
+        # reply in a batch.
+        if status_code == 429:
+            return True
+        return status_code in (400, 403) and "ratelimitexceeded" in text.lower()
+
+    def is_throttled(self, r):
+        return self.is_rate_limited(r.status_code, r.text)
+
+    def throttle(self, seconds=None):
+        self.limiter.throttle(seconds or self.sleep_time)
+
+    def request(self, method, url, **kwargs):
+        # Every API call waits for this client's limiter and feeds back
+        # whether the server throttled it.
+        self.limiter.acquire()
+        r = self.session.request(method, url, **kwargs)
+        self._feedback(r)
+        return r
+
+    async def request_async(self, method, url, **kwargs):
+        await self.limiter.acquire_async()
+        if self.async_session is None:
+            self.async_session = AsyncSession(self.http)
+        r = await self.async_session.request(method, url, **kwargs)
+        self._feedback(r)
+        return r
 
-            def sleep():
-                self.sleeping = True
-                time.sleep(seconds)
-                self.sleeping = False
+    async def close_async(self):
+        if self.async_session is not None:
+            await self.async_session.close()
+            self.async_session = None
 
-            t = Thread(target=sleep)
-            t.start()
-        return seconds
+    def _feedback(self, r):
+        if self.is_throttled(r):
+            self.throttle(parse_retry_after(r.headers.get("Retry-After")))
+        elif r.status_code < 500:
+            self.limiter.success()
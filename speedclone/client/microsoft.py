@@ -1,24 +1,31 @@
 import json
 import os
 import time
-from threading import Lock, Thread
+from threading import Lock
 from urllib.parse import quote
 
-import requests
+from ..ratelimit import RateLimiter, parse_retry_after
+from ..session import PooledSession
+from ..utils import format_time
 
 
 class FileSystemTokenBackend:
     token_url = "https://login.microsoftonline.com/{tenant}/oauth2/v2.0/token"
-    lock = Lock()
+    session = None
 
     def __init__(self, token_path, cred, tenant=None):
         self.token_path = token_path
         self.client = cred
+        self.lock = Lock()
+        self.used = False
+        self.token = None
         self.token_url = self.token_url.format(tenant=tenant if tenant else "common")
 
+    def _load_token(self):
+        # Read on first use, so starting does not open every account's file.
         if os.path.exists(self.token_path):
             with open(self.token_path, "r") as f:
-                self.token = json.load(f)
+                return json.load(f)
         else:
             raise Exception("No token file found.")
 
@@ -26,37 +33,48 @@ class FileSystemTokenBackend:
         with open(self.token_path, "w") as f:
             json.dump(self.token, f)
 
-    def _token_expired(self):
-        if self.token:
-            expired_time = self.token.get("expires_in") + self.token.get("get_time", 0)
-            return expired_time <= int(time.time())
-        else:
-            return True
+    def get_expire_time(self):
+        if not self.token:
+            return 0
+        return self.token.get("expires_in", 0) + self.token.get("get_time", 0)
 
-    def _refresh_accesstoken(self):
+    def _token_expired(self, margin=0):
+        return self.get_expire_time() - margin <= int(time.time())
+
+    def refresh(self, margin=0):
+        # Unless the token is still good for `margin` seconds, e.g. because
+        # another thread just renewed it.
         with self.lock:
-            now_time = int(time.time())
+            if self.token is None:
+                self.token = self._load_token()
+            if self._token_expired(margin):
+                self._refresh_accesstoken()
+                self.used = False
 
-            refresh_token = self.token.get("refresh_token")
-            scope = self.token.get("scope")
+    def _refresh_accesstoken(self):
+        now_time = int(time.time())
 
-            data = {
-                "grant_type": "refresh_token",
-                "refresh_token": refresh_token,
-                "scope": scope,
-            }
-            data.update(self.client)
+        refresh_token = self.token.get("refresh_token")
+        scope = self.token.get("scope")
 
-            r = requests.post(self.token_url, data=data)
-            r.raise_for_status()
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "scope": scope,
+        }
+        data.update(self.client)
 
-            self.token = r.json()
-            self.token["get_time"] = now_time
-            self._update_tokenfile()
+        r = self.session.post(self.token_url, data=data)
+        r.raise_for_status()
+
+        self.token = r.json()
+        self.token["get_time"] = now_time
+        self._update_tokenfile()
 
     def get_token(self):
+        self.used = True
         if self._token_expired():
-            self._refresh_accesstoken()
+            self.refresh()
         return self.token.get("access_token")
 
 
@@ -64,12 +82,23 @@ class OneDrive:
 
     api_url = "https://graph.microsoft.com/v1.0"
     sleep_time = 10
+    http = {}
 
-    def __init__(self, token_backend, proxies=None, drive=None):
+    def __init__(self, token_backend, drive=None):
         self.token_backend = token_backend
-        self.proxies = proxies
         self.drive = "/drives/" + drive if drive else "/me/drive"
-        self.sleeping = False
+        self._session = None
+        self.session_lock = Lock()
+        self.limiter = RateLimiter()
+
+    @property
+    def session(self):
+        # Created on first request, most of a large account set starts idle.
+        if self._session is None:
+            with self.session_lock:
+                if self._session is None:
+                    self._session = PooledSession(self.http)
+        return self._session
 
     def get_headers(self, content_type="application/json"):
         headers = {
@@ -78,7 +107,31 @@ class OneDrive:
         }
         return headers
 
-    def get_upload_url(self, remote_path):
+    def get_children(self, remote_path, next_link=None):
+        headers = self.get_headers()
+        if next_link:
+            return self.request("GET", next_link, headers=headers)
+
+        if remote_path:
+            path = quote("/root:/{}:/children".format(remote_path))
+        else:
+            path = "/root/children"
+        params = {"$top": 1000, "$select": "name,size,file,fileSystemInfo"}
+        r = self.request(
+            "GET", self.api_url + self.drive + path, headers=headers, params=params
+        )
+        return r
+
+    def get_item(self, remote_path):
+        headers = self.get_headers()
+        path = quote("/root:/{}".format(remote_path))
+        params = {"$select": "name,size,file,fileSystemInfo"}
+        r = self.request(
+            "GET", self.api_url + self.drive + path, headers=headers, params=params
+        )
+        return r
+
+    def get_upload_url(self, remote_path, behavior="fail", mtime=None):
 
         url = (
             self.api_url
@@ -86,24 +139,38 @@ class OneDrive:
             + quote("/root:/{}:/createUploadSession".format(remote_path))
         )
         headers = self.get_headers()
-        data = {"item": {"@microsoft.graph.conflictBehavior": "fail"}}
+        item = {"@microsoft.graph.conflictBehavior": behavior}
+        if mtime:
+            item.update(
+                {"fileSystemInfo": {"lastModifiedDateTime": format_time(mtime)}}
+            )
+        data = {"item": item}
 
-        r = requests.post(url, headers=headers, json=data)
+        r = self.request("POST", url, headers=headers, json=data)
 
         if r.status_code == 409:
             return False
         return r
 
-    def sleep(self, seconds=None):
-        if not seconds:
-            seconds = self.sleep_time
-        if not self.sleeping:
+    @property
+    def sleeping(self):
+        return self.limiter.is_paused()
 
-            def sleep():
-                self.sleeping = True
-                time.sleep(seconds)
-                self.sleeping = False
+    def is_throttled(self, r):
+        return r.status_code == 429 or (
+            r.status_code == 503 and "Retry-After" in r.headers
+        )
 
-            t = Thread(target=sleep)
-            t.start()
-        return seconds
+    def throttle(self, seconds=None):
+        self.limiter.throttle(seconds or self.sleep_time)
+
+    def request(self, method, url, **kwargs):
+        # Every API call waits for this client's limiter and feeds back
+        # whether the server throttled it.
+        self.limiter.acquire()
+        r = self.session.request(method, url, **kwargs)
+        if self.is_throttled(r):
+            self.throttle(parse_retry_after(r.headers.get("Retry-After")))
+        elif r.status_code < 500:
+            self.limiter.success()
+        return r
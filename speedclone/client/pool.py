@@ -0,0 +1,117 @@
+import time
+from collections import OrderedDict
+from threading import Condition
+
+
+class ClientLoad:
+    __slots__ = ("in_flight", "bytes", "tasks", "total_bytes", "busy", "busy_since")
+
+    def __init__(self):
+        self.in_flight = 0
+        self.bytes = 0
+        self.tasks = 0
+        self.total_bytes = 0
+        self.busy = 0
+        self.busy_since = None
+
+
+class ClientPool:
+    # Hands out the client with the fewest transfers and bytes in flight.
+    # Idle clients take turns, least recently picked first, and only the few
+    # busy ones are compared, so a pick stays cheap with thousands of
+    # accounts. While every client is throttled callers wait until the first
+    # one resumes.
+    def __init__(self, clients):
+        self.clients = list(clients)
+        self.loads = {id(client): ClientLoad() for client in self.clients}
+        self.idle = OrderedDict((id(client), client) for client in self.clients)
+        self.busy = {}
+        self.cond = Condition()
+        self.started = time.monotonic()
+
+    def _order(self):
+        # Caller holds `cond`. Least loaded first.
+        yield from self.idle.values()
+
+        def key(client):
+            load = self.loads[id(client)]
+            return load.in_flight, load.bytes
+
+        yield from sorted(self.busy.values(), key=key)
+
+    def _pick(self, reserve):
+        # Caller holds `cond`. Returns (client, None), or (None, seconds to
+        # wait) while the clients `reserve` may accept are throttled, or
+        # (None, None) when it refused them all.
+        delays = []
+        for client in self._order():
+            if client.sleeping:
+                delays.append(client.limiter.get_delay())
+            elif reserve is None or reserve(client):
+                if id(client) in self.idle:
+                    self.idle.move_to_end(id(client))
+                return client, None
+        if delays:
+            return None, min(delays)
+        return None, None
+
+    def get(self):
+        # A client for a request that is not counted, like listing a folder.
+        with self.cond:
+            while True:
+                client, delay = self._pick(None)
+                if client:
+                    return client
+                self.cond.wait(delay)
+
+    def acquire(self, size=0, reserve=None, wait=True):
+        # Counts a transfer of `size` bytes against the chosen client until
+        # release(). `reserve(client)` may refuse a client, None is returned
+        # when it refuses all of them, or when all are throttled and not
+        # `wait`.
+        with self.cond:
+            while True:
+                client, delay = self._pick(reserve)
+                if client:
+                    break
+                if delay is None or not wait:
+                    return None
+                self.cond.wait(delay)
+
+            load = self.loads[id(client)]
+            if not load.in_flight:
+                load.busy_since = time.monotonic()
+                del self.idle[id(client)]
+                self.busy[id(client)] = client
+            load.in_flight += 1
+            load.bytes += size
+            load.tasks += 1
+            load.total_bytes += size
+            return client
+
+    def release(self, client, size=0):
+        with self.cond:
+            load = self.loads[id(client)]
+            load.in_flight -= 1
+            load.bytes -= size
+            if not load.in_flight:
+                load.busy += time.monotonic() - load.busy_since
+                load.busy_since = None
+                del self.busy[id(client)]
+                self.idle[id(client)] = client
+            self.cond.notify_all()
+
+    def get_stats(self, client):
+        with self.cond:
+            load = self.loads[id(client)]
+            now = time.monotonic()
+            busy = load.busy
+            if load.busy_since is not None:
+                busy += now - load.busy_since
+            return {
+                "in_flight": load.in_flight,
+                "bytes_in_flight": load.bytes,
+                "tasks": load.tasks,
+                "bytes": load.total_bytes,
+                "utilization": round(busy / max(now - self.started, 1e-9), 3),
+            }
@@ -0,0 +1,43 @@
+import time
+from threading import Thread
+
+from ..utils import console_write
+
+
+class TokenRefresher:
+    # Renews the tokens of the accounts in use `margin` seconds before they
+    # expire, so requests do not wait for the token endpoint. Accounts not
+    # used since their last refresh are left alone, they refresh on demand.
+    interval = 30
+
+    def __init__(self, backends, margin=300):
+        self.backends = list(backends)
+        self.margin = margin
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        if self.margin > 0 and self.backends:
+            self.thread.start()
+        return self
+
+    def refresh_due(self):
+        # Returns the time of the next refresh.
+        now = time.time()
+        wake = now + self.interval
+        for backend in self.backends:
+            if not backend.used:
+                continue
+            due = backend.get_expire_time() - self.margin
+            if due > now:
+                wake = min(wake, due)
+                continue
+            try:
+                backend.refresh(self.margin)
+            except Exception as e:
+                console_write("error", "Token refresh failed: {}".format(e))
+        return wake
+
+    def run(self):
+        while True:
+            wake = self.refresh_due()
+            time.sleep(max(wake - time.time(), 1))
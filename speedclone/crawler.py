@@ -0,0 +1,56 @@
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .utils import console_write
+
+
+class Crawler:
+    # Walks a tree iteratively. Jobs are tuples starting with their path and
+    # `list_page(job)` returns `(items, next_page, folders)`: the items of that
+    # page, the job for the following page (or None) and the jobs of the sub
+    # folders found. Items are yielded as soon as their page is listed.
+    retry_delay = 1
+
+    def __init__(self, list_page, concurrency=4, retries=3):
+        self.list_page = list_page
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+
+    def _run(self, job, attempt):
+        if attempt:
+            time.sleep(self.retry_delay * attempt)
+        return self.list_page(job)
+
+    def crawl(self, jobs):
+        self.failed = 0
+        pending = deque((job, 0) for job in jobs)
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        try:
+            while pending or running:
+                while pending and len(running) < self.concurrency:
+                    job, attempt = pending.popleft()
+                    running[executor.submit(self._run, job, attempt)] = (job, attempt)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, attempt = running.pop(future)
+                    try:
+                        items, next_page, folders = future.result()
+                    except Exception as e:
+                        console_write(mode="error", message="{}: {}".format(job[0], e))
+                        if attempt < self.retries:
+                            pending.append((job, attempt + 1))
+                        else:
+                            self.failed += 1
+                        continue
+
+                    # Finish the pages of a folder before opening new ones.
+                    if next_page:
+                        pending.appendleft((next_page, 0))
+                    pending.extend((folder, 0) for folder in folders)
+                    yield from items
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
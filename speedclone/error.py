@@ -31,3 +31,9 @@ class TaskExistError(TaskException):
             msg = "{}: File already exists".format(t.get_relative_path())
             kwargs["msg"] = msg
         super().__init__(**kwargs)
+
+
+class RequestError(Exception):
+    def __init__(self, status_code, msg):
+        super().__init__(msg)
+        self.status_code = status_code
@@ -0,0 +1,112 @@
+import errno
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409
+
+UNSUPPORTED_ERRORS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+}
+
+
+def _clone(src, dst):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+    except OSError as e:
+        if e.errno in UNSUPPORTED_ERRORS:
+            return False
+        raise
+    return True
+
+
+def _copy_file_range(src, dst, offset, count):
+    return os.copy_file_range(src, dst, count, offset, offset)
+
+
+def _sendfile(src, dst, offset, count):
+    os.lseek(dst, offset, os.SEEK_SET)
+    return os.sendfile(dst, src, offset, count)
+
+
+def _pread_pwrite(src, dst, offset, count):
+    return os.pwrite(dst, os.pread(src, count, offset), offset)
+
+
+def _iter_methods():
+    if hasattr(os, "copy_file_range"):
+        yield _copy_file_range
+    if hasattr(os, "sendfile"):
+        yield _sendfile
+    yield _pread_pwrite
+
+
+def _iter_extents(fd, size):
+    # Yield (start, end) of the regions holding data, skipping sparse holes.
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            yield offset, size
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        offset = end
+
+
+def is_supported():
+    return hasattr(os, "pread") and hasattr(os, "pwrite")
+
+
+def copy_file(src_path, dst_path, step_size, update):
+    with open(src_path, "rb") as fsrc, open(dst_path, "wb") as fdst:
+        src, dst = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(src).st_size
+
+        if _clone(src, dst):
+            update(size)
+            return
+
+        methods = _iter_methods()
+        method = next(methods)
+        copied = 0
+
+        for start, end in _iter_extents(src, size):
+            if start > copied:
+                update(start - copied)
+            offset = start
+            while offset < end:
+                try:
+                    n = method(src, dst, offset, min(step_size, end - offset))
+                except OSError as e:
+                    method = next(methods, None)
+                    if e.errno not in UNSUPPORTED_ERRORS or method is None:
+                        raise
+                    continue
+                if not n:
+                    break
+                offset += n
+                update(n)
+            copied = offset
+
+        if size > copied:
+            update(size - copied)
+        os.ftruncate(dst, size)
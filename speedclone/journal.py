@@ -0,0 +1,122 @@
+import json
+import os
+import time
+from threading import Lock
+
+
+class Journal:
+    flush_every = 100
+    flush_interval = 5
+    compact_ratio = 2
+    compact_min = 1000
+
+    def __init__(self, path, source, dest):
+        self.path = path
+        self.job = " ".join((source, dest))
+        self.dest = dest.rstrip("/")
+        self.lock = Lock()
+        self.done = {}
+        self.sessions = {}
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.f = None
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        entries = {}
+        lines = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn last line after a crash.
+                    continue
+                lines += 1
+                entries[(entry["job"], entry["path"])] = entry
+
+        for (job, path), entry in entries.items():
+            if job != self.job:
+                continue
+            if entry["outcome"] in ("done", "exists"):
+                # Entries written before sources were recorded only know sizes.
+                self.done[path] = entry.get("source", {"size": entry["size"]})
+            elif entry.get("session"):
+                self.sessions[path] = (entry["size"], entry["session"])
+
+        if lines > self.compact_min and lines > len(entries) * self.compact_ratio:
+            self._compact(entries.values())
+
+    def _compact(self, entries):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _get_source(self, task):
+        # What identifies the source file: its metadata and, for Drive, its id.
+        get_meta = getattr(task, "get_meta", None)
+        source = dict(get_meta()) if get_meta else {"size": task.get_total()}
+        file_id = getattr(task, "file_id", None)
+        if file_id:
+            source["id"] = file_id
+        return source
+
+    def is_done(self, task):
+        # A file changed since it was recorded is not done, e.g. for --sync.
+        source = self.done.get(task.get_relative_path())
+        if source is None:
+            return False
+        current = self._get_source(task)
+        return all(current.get(k) == v for k, v in source.items())
+
+    def restore(self, task):
+        # Hand an unfinished upload session back to its task.
+        session = self.sessions.pop(task.get_relative_path(), None)
+        if session and session[0] == task.get_total():
+            task.upload_session = session[1]
+
+    def record(self, task, outcome):
+        path = task.get_relative_path()
+        source = self._get_source(task)
+        entry = {
+            "job": self.job,
+            "path": path,
+            "dest": "/".join((self.dest, path)),
+            "size": task.get_total(),
+            "source": source,
+            "outcome": outcome,
+            "session": getattr(task, "upload_session", None),
+            "time": int(time.time()),
+        }
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            if outcome in ("done", "exists"):
+                self.done[path] = source
+            self.buffer.append(line)
+            if (
+                len(self.buffer) >= self.flush_every
+                or time.monotonic() - self.last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def _flush(self):
+        if self.f is None:
+            self.f = open(self.path, "a", encoding="utf-8")
+        self.f.write("".join(self.buffer))
+        self.f.flush()
+        self.buffer.clear()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.buffer:
+                self._flush()
+            if self.f is not None:
+                self.f.close()
+                self.f = None
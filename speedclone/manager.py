@@ -1,84 +1,205 @@
+import json
 import time
-from concurrent.futures import CancelledError, ThreadPoolExecutor
-from queue import Empty, Queue
-from threading import Thread
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from functools import partial
+from threading import Condition, Event, Thread
 
+from .buffer import buffer_stats
 from .error import TaskExistError, TaskFailError, TaskSleepError
 from .utils import console_write
 
 
+def summarize_clients(stats):
+    # Totals instead of one entry per client, so the line stays short with
+    # thousands of accounts.
+    clients = stats.pop("clients", None)
+    if clients:
+        stats["clients"] = len(clients)
+        for key in ("throttled", "waited", "tasks", "bytes"):
+            stats[key] = round(sum(c.get(key, 0) for c in clients), 2)
+        stats["paused"] = sum(1 for c in clients if c.get("paused"))
+        quota = [c["quota_left"] for c in clients if "quota_left" in c]
+        if quota:
+            stats["quota_left"] = sum(quota)
+        stats["utilization"] = round(
+            sum(c.get("utilization", 0) for c in clients) / len(clients), 3
+        )
+    return stats
+
+
 class TransferManager:
     def __init__(
-        self, download_manager, upload_manager, bar_manager, sleep_time, max_workers
+        self,
+        download_manager,
+        upload_manager,
+        bar_manager,
+        sleep_time,
+        max_workers,
+        journal=None,
+        max_queue=1000,
+        large_threshold=0,
+        large_workers=0,
+        stats_interval=0,
     ):
         self.download_manager = download_manager
         self.upload_manager = upload_manager
         self.bar_manager = bar_manager
+        self.journal = journal
 
         self.sleep_time = sleep_time
         self.max_workers = max_workers
+        self.max_queue = max_queue
+        # Without large workers a large lane would never start its tasks.
+        self.large_threshold = large_threshold if large_workers > 0 else 0
+
+        self.stats_interval = stats_interval
+        self.stats_stopped = Event()
 
         self.pusher_thread = None
         self.pusher_finished = False
+        self.pusher_failed = False
 
-        self.task_queue = Queue()
-        self.taskdone_queue = Queue()
-        self.sleep_queue = Queue()
-        self.sleep_taskdone_queue = Queue()
+        # Tasks are split into a small (0) and a large (1) lane, each with its
+        # own queue and worker slots. `unfinished` counts tasks not yet done,
+        # wherever they are. `running` counts busy worker slots per lane and
+        # `in_flight` also the transfers workers handed off to a future. All
+        # of them are guarded by `cond`.
+        self.cond = Condition()
+        self.task_queues = (deque(), deque())
+        self.lane_workers = (max_workers, large_workers if self.large_threshold else 0)
+        self.unfinished = 0
+        self.running = [0, 0]
+        self.in_flight = 0
 
-        self.futures = []
+        self.futures = set()
 
-    def put_task(self, task):
-        self.taskdone_queue.put(None)
-        self.task_queue.put(task)
+    def notify(self):
+        # Caller holds `cond`.
+        self.cond.notify_all()
+
+    def get_lane(self, task):
+        # Tasks of unknown size go to the small lane.
+        total = task.get_total()
+        if self.large_threshold and total and total >= self.large_threshold:
+            return 1
+        return 0
+
+    def put_task(self, task, wait=False):
+        # The lister waits for room in the task's lane. Retries from callbacks
+        # never wait, they are already counted.
+        queue = self.task_queues[self.get_lane(task)]
+        with self.cond:
+            while wait and len(queue) >= self.max_queue and not self.pusher_finished:
+                self.cond.wait()
+            queue.append(task)
+            self.unfinished += 1
+            self.notify()
 
     def task_done(self):
-        if not self.taskdone_queue.empty():
-            self.taskdone_queue.get()
+        with self.cond:
+            self.unfinished -= 1
+            self.in_flight -= 1
+            self.notify()
+
+    def release_worker(self, lane, future):
+        with self.cond:
+            self.running[lane] -= 1
+            self.futures.discard(future)
+            self.notify()
+
+    def get_counts(self):
+        with self.cond:
+            return {
+                "queued": len(self.task_queues[0]) + len(self.task_queues[1]),
+                "queued_large": len(self.task_queues[1]),
+                "running": sum(self.running),
+                "running_large": self.running[1],
+                "in_flight": self.in_flight,
+                "unfinished": self.unfinished,
+            }
+
+    def get_stats(self):
+        stats = {"tasks": self.get_counts(), "buffers": buffer_stats.get_stats()}
+        for name, manager in (
+            ("source", self.download_manager),
+            ("dest", self.upload_manager),
+        ):
+            get_stats = getattr(manager, "get_stats", None)
+            if get_stats:
+                stats[name] = summarize_clients(get_stats())
+        return stats
+
+    def write_stats(self):
+        console_write("stats", "Stats: " + json.dumps(self.get_stats()))
+
+    def run_stats_writer(self):
+        def writer():
+            while not self.stats_stopped.wait(self.stats_interval):
+                self.write_stats()
+
+        if self.stats_interval > 0:
+            Thread(target=writer, daemon=True).start()
 
     def handle_sleep(self, e):
+        # Throttling is paced per client by its limiter, only this task waits.
         self.put_task(e.task)
-        if not self.sleep_queue.empty():
-            self.sleep_queue.put(e.sleep_time)
         self.bar_manager.sleep(e)
 
-    def handle_error(self, e):
-        self.put_task(e.task)
-        self.bar_manager.error(e)
+    def handle_partial(self, task):
+        # Remember where an interrupted upload can be resumed.
+        if self.journal and getattr(task, "upload_session", None):
+            self.journal.record(task, "partial")
+
+    def handle_error(self, e, task):
+        # Plain exceptions carry neither the task nor a message.
+        self.handle_partial(task)
+        self.put_task(task)
+        self.bar_manager.error(TaskFailError(exce=e, task=task, msg=str(e)))
 
     def handle_exists(self, e):
+        if self.journal:
+            self.journal.record(e.task, "exists")
         self.bar_manager.exists(e)
 
+    def handle_done(self, task):
+        if self.journal:
+            self.journal.record(task, "done")
+
     def handle_fail(self, e):
+        self.handle_partial(e.task)
         self.put_task(e.task)
         self.bar_manager.fail(e)
 
     def run_task_pusher(self):
         def pusher():
-            for task in self.download_manager.iter_tasks():
-                if self.pusher_finished:
-                    return
-                else:
-                    self.put_task(task)
-            self.pusher_finished = True
+            try:
+                for task in self.download_manager.iter_tasks():
+                    if self.pusher_finished:
+                        return
+                    if self.journal:
+                        if self.journal.is_done(task):
+                            continue
+                        self.journal.restore(task)
+                    self.put_task(task, wait=True)
+            except Exception as e:
+                self.pusher_failed = True
+                console_write("error", "Listing stopped: {}".format(e))
+            finally:
+                with self.cond:
+                    self.pusher_finished = True
+                    self.notify()
 
         self.pusher_thread = Thread(target=pusher)
         self.pusher_thread.start()
 
     def finished(self):
-        return self.taskdone_queue.empty() and self.pusher_finished
-
-    def sleep(self):
-        if not self.sleep_queue.empty():
-            self.sleep_taskdone_queue.put(None)
-            sleep_time = self.sleep_queue.get()
-            time.sleep(sleep_time)
-            self.sleep_taskdone_queue.get()
-            self.sleep_taskdone_queue.task_done()
+        return self.unfinished == 0 and self.pusher_finished
 
-    def done_callback(self, task):
+    def done_callback(self, future, task=None):
+        handed_off = False
         try:
-            task.result()
+            result = future.result()
         except CancelledError:
             pass
         except TaskExistError as e:
@@ -88,55 +209,95 @@ class TransferManager:
         except TaskFailError as e:
             self.handle_fail(e)
         except Exception as e:
-            self.handle_error(e)
+            self.handle_error(e, task)
+        else:
+            # Workers may hand the transfer off and return a future for it.
+            if isinstance(result, Future):
+                handed_off = True
+                result.add_done_callback(partial(self.done_callback, task=task))
+            else:
+                self.handle_done(task)
         finally:
-            self.task_done()
+            if not handed_off:
+                self.task_done()
 
     def clear_all_futueres(self):
-        [f.cancel() for f in self.futures]
+        with self.cond:
+            futures = list(self.futures)
+        [f.cancel() for f in futures]
+
+    def _pick_lane(self):
+        # Returns (queue lane, slot lane) of the next task to start, or None.
+        small, large = self.task_queues
+        # Large files go first so they do not make up the long tail.
+        if large and self.running[1] < self.lane_workers[1]:
+            return 1, 1
+        if small:
+            if self.running[0] < self.lane_workers[0]:
+                return 0, 0
+            # Small files may borrow large slots nobody is waiting for.
+            if not large and self.running[1] < self.lane_workers[1]:
+                return 0, 1
+        return None
+
+    def take_task(self):
+        # Caller holds `cond`. Returns (task, slot lane) when a task is queued
+        # and a worker slot of its lane is free, otherwise None.
+        lanes = self._pick_lane()
+        if not lanes:
+            return None
+        lane, slot = lanes
+        self.running[slot] += 1
+        self.in_flight += 1
+        self.notify()
+        return self.task_queues[lane].popleft(), slot
 
     def get_task(self):
-        try:
-            task = self.task_queue.get(timeout=self.sleep_time)
-        except Empty:
-            return
-        else:
-            return task
+        # Wait for the next task, or until everything is done.
+        with self.cond:
+            while True:
+                if self.finished():
+                    return None, None
+                taken = self.take_task()
+                if taken:
+                    return taken
+                self.cond.wait()
 
     def get_worker(self, task):
         _worker = self.upload_manager.get_worker(task)
         bar = self.bar_manager.get_bar(task)
 
         def worker():
-            self.sleep_taskdone_queue.join()
             return _worker(bar)
 
         return worker
 
     def add_to_excutor(self, executor):
         while True:
-            if self.finished():
+            task, slot = self.get_task()
+            if task is None:
                 break
-            else:
-                self.sleep()
-                task = self.get_task()
-                if not task:
-                    continue
-                worker = self.get_worker(task)
-                future = executor.submit(worker)
-                future.add_done_callback(self.done_callback)
-                self.futures.append(future)
-            time.sleep(self.sleep_time)
+            worker = self.get_worker(task)
+            future = executor.submit(worker)
+            with self.cond:
+                self.futures.add(future)
+            future.add_done_callback(partial(self.release_worker, slot))
+            future.add_done_callback(partial(self.done_callback, task=task))
+            if self.sleep_time:
+                time.sleep(self.sleep_time)
 
     def run(self):
         self.run_task_pusher()
-        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.run_stats_writer()
+        executor = ThreadPoolExecutor(max_workers=sum(self.lane_workers))
         try:
             self.add_to_excutor(executor)
         except KeyboardInterrupt:
             if not self.pusher_finished:
                 console_write("error", "Stopping pusher thread.")
-                self.pusher_finished = True
+                with self.cond:
+                    self.pusher_finished = True
+                    self.notify()
                 console_write("error", "Waitting pusher thread.")
                 self.pusher_thread.join()
 
@@ -145,9 +306,18 @@ class TransferManager:
             executor.shutdown()
 
             console_write("error", "Clearing queues.")
-            self.sleep_queue.queue.clear()
-            self.task_queue.queue.clear()
-            self.taskdone_queue.queue.clear()
+            with self.cond:
+                [queue.clear() for queue in self.task_queues]
 
             console_write("error", "Closing bars.")
             self.bar_manager.exit()
+        else:
+            finish = getattr(self.download_manager, "finish", None)
+            if finish and not self.pusher_failed:
+                finish()
+        finally:
+            if self.stats_interval > 0:
+                self.stats_stopped.set()
+                self.write_stats()
+            if self.journal:
+                self.journal.close()
@@ -0,0 +1,115 @@
+import sqlite3
+import time
+from collections import deque
+from threading import Lock
+
+
+class QuotaLedger:
+    # Bytes each account uploaded within the last `window` seconds. With a
+    # db_path the uploads are kept in SQLite, so reruns and the processes of
+    # --processes see what was sent before. Uploads in progress are reserved
+    # in memory only. A file larger than `limit` only goes to an account
+    # with nothing uploaded or reserved in its window, as Drive lets such an
+    # upload through and blocks the account for the rest of the day.
+    window = 24 * 3600
+
+    def __init__(self, limit, db_path=None):
+        self.limit = limit
+        self.db_path = db_path
+        self.lock = Lock()
+        self.conn = None
+        self.uploads = {}
+        self.used = {}
+        self.pending = {}
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.db_path, check_same_thread=False, isolation_level=None, timeout=30
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "account TEXT, time REAL, size INTEGER)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS uploads_account ON uploads (account, time)"
+            )
+        return self.conn
+
+    def _get_uploads(self, account, now):
+        # Caller holds `lock`.
+        uploads = self.uploads.get(account)
+        if uploads is None:
+            uploads = self.uploads[account] = deque()
+            self.used[account] = 0
+            if self.db_path:
+                conn = self._connect()
+                conn.execute(
+                    "DELETE FROM uploads WHERE account = ? AND time <= ?",
+                    (account, now - self.window),
+                )
+                rows = conn.execute(
+                    "SELECT time, size FROM uploads WHERE account = ? ORDER BY time",
+                    (account,),
+                )
+                for t, size in rows:
+                    uploads.append((t, size))
+                    self.used[account] += size
+
+        while uploads and uploads[0][0] <= now - self.window:
+            self.used[account] -= uploads.popleft()[1]
+        return uploads
+
+    def _get_remaining(self, account, now):
+        self._get_uploads(account, now)
+        return self.limit - self.used[account] - self.pending.get(account, 0)
+
+    def get_remaining(self, account):
+        with self.lock:
+            return max(self._get_remaining(account, time.time()), 0)
+
+    def reserve(self, account, size):
+        with self.lock:
+            if self._get_remaining(account, time.time()) < min(size, self.limit):
+                return False
+            self.pending[account] = self.pending.get(account, 0) + size
+            return True
+
+    def release(self, account, size):
+        with self.lock:
+            self.pending[account] -= size
+
+    def commit(self, account, size):
+        with self.lock:
+            now = time.time()
+            self.pending[account] -= size
+            self._get_uploads(account, now).append((now, size))
+            self.used[account] += size
+            if self.db_path:
+                self._connect().execute(
+                    "INSERT INTO uploads VALUES (?, ?, ?)", (account, now, size)
+                )
+
+    def _get_delay(self, account, size, now):
+        missing = min(size, self.limit) - self._get_remaining(account, now)
+        if missing <= 0:
+            return 0
+        for t, n in self._get_uploads(account, now):
+            missing -= n
+            if missing <= 0:
+                return t + self.window - now
+        return None
+
+    def get_delay(self, account, size):
+        # Seconds until `size` bytes fit, as far as finished uploads go.
+        with self.lock:
+            return self._get_delay(account, size, time.time())
+
+    def get_min_delay(self, size):
+        # The shortest get_delay() of the accounts this ledger has seen, None
+        # when finished uploads expiring will not make room on any.
+        with self.lock:
+            now = time.time()
+            delays = [self._get_delay(a, size, now) for a in list(self.uploads)]
+            delays = [d for d in delays if d is not None]
+            return min(delays) if delays else None
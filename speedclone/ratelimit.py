@@ -0,0 +1,109 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+
+def parse_retry_after(value):
+    # Retry-After holds either seconds or an HTTP date.
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    # Token bucket for one client. The rate grows additively while requests
+    # succeed and is cut multiplicatively when the server throttles, at most
+    # once per `cooldown` so a burst of 429s counts as one signal.
+    rate = 10
+    max_rate = 100
+    min_rate = 0.5
+    increase = 1
+    decrease = 0.5
+    cooldown = 1
+
+    def __init__(self, rate=None):
+        self.rate = rate or self.rate
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.lock = Lock()
+
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0
+
+    def _refill(self, now):
+        burst = max(self.rate, 1)
+        self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _reserve(self):
+        # Takes a token and returns 0, or returns how long to wait first.
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            delay = self.paused_until - now
+            if delay <= 0:
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return 0
+                delay = (1 - self.tokens) / self.rate
+            self.waited += delay
+            return delay
+
+    def acquire(self):
+        while True:
+            delay = self._reserve()
+            if not delay:
+                return
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        while True:
+            delay = self._reserve()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    def success(self):
+        with self.lock:
+            # About `increase` requests per second more for each second of
+            # successful traffic.
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def throttle(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            self.throttled += 1
+            if now - self.last_decrease >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.last_decrease = now
+            self.tokens = min(self.tokens, 0)
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+    def get_delay(self):
+        return max(self.paused_until - time.monotonic(), 0)
+
+    def is_paused(self):
+        return self.get_delay() > 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "rate": round(self.rate, 2),
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "waited": round(self.waited, 2),
+                "paused": round(self.get_delay(), 2),
+            }
@@ -0,0 +1,132 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .buffer import buffer_stats, iter_chunks, skip_chunks
+
+
+class PooledSession(requests.Session):
+    pool_connections = 10
+    pool_maxsize = 10
+    pool_block = False
+
+    def __init__(self, http=None):
+        super().__init__()
+        http = http or {}
+        pool = http.get("pool", {})
+
+        self.headers.update(http.get("headers", {}))
+        self.proxies.update(http.get("proxies", {}))
+
+        if "verify" in http:
+            self.verify = http["verify"]
+        if "cert" in http:
+            self.cert = http["cert"]
+
+        adapter = HTTPAdapter(
+            pool_connections=pool.get("connections", self.pool_connections),
+            pool_maxsize=pool.get("maxsize", self.pool_maxsize),
+            pool_block=pool.get("block", self.pool_block),
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def _iter_pools(self):
+        for adapter in set(self.adapters.values()):
+            managers = [adapter.poolmanager, *adapter.proxy_manager.values()]
+            for manager in managers:
+                for key in manager.pools.keys():
+                    pool = manager.pools.get(key)
+                    if pool is not None:
+                        yield pool
+
+    def get_stats(self):
+        num_requests = num_connections = 0
+        for pool in self._iter_pools():
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        return {
+            "requests": num_requests,
+            "connections": num_connections,
+            "reused": max(num_requests - num_connections, 0),
+        }
+
+
+def merge_stats(sessions):
+    # None stands for a session never created.
+    stats = {"requests": 0, "connections": 0, "reused": 0}
+    for s in sessions:
+        if s is None:
+            continue
+        for k, v in s.get_stats().items():
+            stats[k] += v
+    return stats
+
+
+def _read_range(request, start, end):
+    headers = {"Range": "bytes={}-{}".format(start, end)}
+    with request(headers) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise Exception("Range request ignored by server")
+        data = r.content
+    if len(data) != end - start + 1:
+        raise Exception("Range response length mismatch")
+    buffer_stats.record(chunks=1, copies=1, allocations=1)
+    return memoryview(data)
+
+
+def _iter_response(r, chunk_size, offset):
+    chunks = iter_chunks(r.iter_content(chunk_size=chunk_size))
+    if offset and r.status_code != 206:
+        # The server ignored the range and sent the whole file.
+        chunks = skip_chunks(chunks, offset)
+    return chunks
+
+
+def iter_ranged(request, size, chunk_size, connections=1, offset=0):
+    # `request(headers)` opens a streaming GET of the resource. Segments of
+    # `chunk_size` bytes starting at `offset` are fetched on up to
+    # `connections` connections and yielded in order; at most `connections`
+    # segments are buffered.
+    if connections <= 1 or size - offset <= chunk_size:
+        headers = {"Range": "bytes={}-".format(offset)} if offset else None
+        with request(headers) as r:
+            r.raise_for_status()
+            yield from _iter_response(r, chunk_size, offset)
+        return
+
+    first_end = offset + chunk_size - 1
+    with request({"Range": "bytes={}-{}".format(offset, first_end)}) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            yield from _iter_response(r, chunk_size, offset)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=connections)
+        pending = deque()
+        starts = iter(range(first_end + 1, size, chunk_size))
+
+        def submit():
+            for start in starts:
+                end = min(start + chunk_size, size) - 1
+                pending.append(executor.submit(_read_range, request, start, end))
+                return
+
+        try:
+            for _ in range(connections - 1):
+                submit()
+
+            first = r.content
+            if len(first) != chunk_size:
+                raise Exception("Range response length mismatch")
+            buffer_stats.record(chunks=1, copies=1, allocations=1)
+            yield memoryview(first)
+
+            while pending:
+                submit()
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,271 @@
+import multiprocessing
+import signal
+from itertools import count
+from queue import Empty, Full
+from threading import Thread
+from types import SimpleNamespace
+
+from .aio import AsyncTransferManager
+from .manager import TransferManager
+from .transfers import load_transfer
+from .utils import console_write
+
+
+class QueueSource:
+    # Download manager of a worker process, yields the tasks the coordinator
+    # sends until it sends None. Folders the coordinator resolved for a task
+    # come along with it.
+    def __init__(self, task_queue, source, dest):
+        self.task_queue = task_queue
+        self.bind_task = getattr(source, "bind_task", None)
+        self.add_dirs = getattr(dest, "add_dirs", None)
+
+    def iter_tasks(self):
+        while True:
+            item = self.task_queue.get()
+            if item is None:
+                return
+            task, dirs = item
+            if self.bind_task:
+                self.bind_task(task)
+            if dirs and self.add_dirs:
+                self.add_dirs(dirs)
+            yield task
+
+
+class RemoteBar:
+    def __init__(self, events, key):
+        self.events = events
+        self.key = key
+
+    def init_bar(self, total, desc):
+        self.events.put(("init_bar", self.key, total, desc))
+
+    def update(self, n):
+        self.events.put(("update", self.key, n))
+
+    def close(self):
+        self.events.put(("close", self.key))
+
+
+class RemoteBarManager:
+    # Sends bar calls and messages to the coordinator, which owns the
+    # terminal.
+    def __init__(self, events, index):
+        self.events = events
+        self.index = index
+        self.keys = count()
+
+    def get_bar(self, task):
+        key = (self.index, next(self.keys))
+        self.events.put(("get_bar", key, task))
+        return RemoteBar(self.events, key)
+
+    def _message(self, kind, e):
+        self.events.put(
+            (
+                kind,
+                getattr(e, "task", None),
+                getattr(e, "msg", str(e)),
+                getattr(e, "sleep_time", None),
+            )
+        )
+
+    def sleep(self, e):
+        self._message("sleep", e)
+
+    def error(self, e):
+        self._message("error", e)
+
+    def exists(self, e):
+        self._message("exists", e)
+
+    def fail(self, e):
+        self._message("fail", e)
+
+    def exit(self):
+        pass
+
+
+class RemoteJournal:
+    # The coordinator filters finished files before sending them, workers
+    # only report outcomes.
+    def __init__(self, events):
+        self.events = events
+
+    def is_done(self, task):
+        return False
+
+    def restore(self, task):
+        pass
+
+    def record(self, task, outcome):
+        self.events.put(("record", task, outcome))
+
+    def close(self):
+        pass
+
+
+def run_worker(index, processes, task_queue, events, setup):
+    # Ctrl-C reaches the coordinator, which stops sending tasks.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    f_conf, f_path, t_conf, t_path, transfers, args = setup
+    args.shard = (index, processes)
+    try:
+        source = load_transfer(transfers, f_conf, f_path, args)
+        dest = load_transfer(transfers, t_conf, t_path, args)
+
+        manager_cls = TransferManager
+        if args.engine == "asyncio":
+            manager_cls = AsyncTransferManager
+
+        manager = manager_cls(
+            download_manager=QueueSource(task_queue, source, dest),
+            upload_manager=dest,
+            bar_manager=RemoteBarManager(events, index),
+            sleep_time=args.interval,
+            max_workers=args.workers,
+            journal=RemoteJournal(events),
+            max_queue=args.workers,
+            large_threshold=args.large_threshold,
+            large_workers=args.large_workers,
+            stats_interval=args.stats,
+        )
+        manager.run()
+    except Exception as e:
+        events.put(("stopped", index, str(e), None))
+
+
+class ShardedTransferManager:
+    # Lists the source in this process and hands the tasks to worker
+    # processes, each with its own TransferManager and its own share of the
+    # accounts. Bars, messages and the journal stay here, and so does folder
+    # creation when the destination supports it, as processes do not see each
+    # other's folders.
+    put_timeout = 1
+
+    def __init__(
+        self,
+        download_manager,
+        upload_manager,
+        bar_manager,
+        processes,
+        setup,
+        journal=None,
+        max_queue=1000,
+    ):
+        self.download_manager = download_manager
+        self.resolve_dirs = getattr(upload_manager, "resolve_dirs", None)
+        self.bar_manager = bar_manager
+        self.processes = processes
+        self.setup = setup
+        self.journal = journal
+
+        self.bars = {}
+        self.failed = False
+
+        context = multiprocessing.get_context("spawn")
+        self.task_queue = context.Queue(max_queue)
+        self.events = context.Queue()
+        self.workers = [
+            context.Process(
+                target=run_worker,
+                args=(i, processes, self.task_queue, self.events, setup),
+            )
+            for i in range(processes)
+        ]
+
+    def handle_event(self, kind, key, *args):
+        if kind == "get_bar":
+            self.bars[key] = self.bar_manager.get_bar(args[0])
+        elif kind == "init_bar":
+            self.bars[key].init_bar(*args)
+        elif kind == "update":
+            self.bars[key].update(*args)
+        elif kind == "close":
+            self.bars.pop(key).close()
+        elif kind == "record":
+            if self.journal:
+                self.journal.record(key, *args)
+        elif kind == "stopped":
+            self.failed = True
+            console_write("error", "Process {} stopped: {}".format(key, args[0]))
+        else:
+            msg, sleep_time = args
+            e = SimpleNamespace(task=key, msg=msg, sleep_time=sleep_time)
+            getattr(self.bar_manager, kind)(e)
+
+    def run_event_loop(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            self.handle_event(*event)
+
+    def put_task(self, item):
+        while True:
+            try:
+                self.task_queue.put(item, timeout=self.put_timeout)
+                return
+            except Full:
+                if not any(p.is_alive() for p in self.workers):
+                    raise Exception("All worker processes stopped.")
+
+    def push_tasks(self):
+        for task in self.download_manager.iter_tasks():
+            if self.journal:
+                if self.journal.is_done(task):
+                    continue
+                self.journal.restore(task)
+            dirs = self.resolve_dirs(task) if self.resolve_dirs else None
+            self.put_task((task, dirs))
+
+    def stop_workers(self):
+        for p in self.workers:
+            if p.is_alive():
+                self.put_task(None)
+        for p in self.workers:
+            p.join()
+            if p.exitcode:
+                self.failed = True
+
+    def clear_queue(self):
+        try:
+            while True:
+                self.task_queue.get_nowait()
+        except Empty:
+            pass
+
+    def run(self):
+        for p in self.workers:
+            p.start()
+        event_thread = Thread(target=self.run_event_loop)
+        event_thread.start()
+
+        interrupted = False
+        try:
+            try:
+                self.push_tasks()
+            except Exception as e:
+                self.failed = True
+                console_write("error", "Listing stopped: {}".format(e))
+            self.stop_workers()
+        except KeyboardInterrupt:
+            console_write("error", "Stopping worker processes.")
+            interrupted = self.failed = True
+            self.clear_queue()
+            self.stop_workers()
+        finally:
+            self.events.put(None)
+            event_thread.join()
+            if self.journal:
+                self.journal.close()
+
+        if interrupted:
+            console_write("error", "Closing bars.")
+            self.bar_manager.exit()
+            return
+
+        finish = getattr(self.download_manager, "finish", None)
+        if finish and not self.failed:
+            finish()
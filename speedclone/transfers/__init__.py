@@ -0,0 +1,9 @@
+import importlib
+
+
+def load_transfer(transfers, conf, path, args):
+    trans = transfers.get(conf.get("transfer"))
+    transfer_cls = getattr(
+        importlib.import_module(__name__ + "." + trans.get("mod")), trans.get("cls")
+    )
+    return transfer_cls.get_transfer(conf, path, args)
@@ -1,21 +1,76 @@
-from ..error import TaskExistError, TaskFailError
-from ..utils import norm_path, iter_path
+import mmap
 import os
 
+from ..buffer import iter_readinto, prefetch
+from ..error import TaskExistError, TaskFailError
+from ..fastcopy import copy_file, is_supported
+from ..utils import DataIter, is_same_file, iter_path, norm_path
+
 
 class FileSystemTransferDownloadTask:
-    def __init__(self, file_path, relative_path):
+    __slots__ = ("file_path", "relative_path", "read_mode", "upload_session")
+
+    def __init__(self, file_path, relative_path, read_mode="buffered"):
         self.file_path = file_path
         self.relative_path = relative_path
-
-    def iter_data(self, chunk_size=(10 * 1024 ** 2)):
-        with open(self.file_path, "rb") as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if chunk:
-                    yield chunk
-                else:
-                    return
+        self.read_mode = read_mode
+
+    def _iter_fadvise(self, f, chunk_size, offset, buffers):
+        fd = f.fileno()
+        os.posix_fadvise(fd, offset, 0, os.POSIX_FADV_SEQUENTIAL)
+        for chunk in iter_readinto(f, chunk_size, buffers):
+            end = offset + len(chunk)
+            os.posix_fadvise(fd, end, chunk_size, os.POSIX_FADV_WILLNEED)
+            yield chunk
+            # The chunk was copied into our buffer, so its pages can go.
+            os.posix_fadvise(fd, offset, end - offset, os.POSIX_FADV_DONTNEED)
+            offset = end
+
+    def _iter_mmap(self, f, chunk_size, start, buffers):
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        if not size:
+            return
+
+        mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        page = mmap.PAGESIZE
+        view = None
+        try:
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mm)
+            sent = start // page * page
+            for offset in range(start, size, chunk_size):
+                end = min(offset + chunk_size, size)
+                if end < size:
+                    ahead = end // page * page
+                    mm.madvise(mmap.MADV_WILLNEED, ahead, min(chunk_size, size - ahead))
+                yield view[offset:end]
+                # The last `buffers - 1` chunks may still be read by the uploader.
+                done = (end - (buffers - 1) * chunk_size) // page * page
+                if done > sent:
+                    mm.madvise(mmap.MADV_DONTNEED, sent, done - sent)
+                    os.posix_fadvise(fd, sent, done - sent, os.POSIX_FADV_DONTNEED)
+                    sent = done
+        finally:
+            if view is not None:
+                view.release()
+            # The chunks are views on the mapping too and a prefetching caller
+            # still holds the last ones, so it is unmapped once they are gone
+            # rather than closed here.
+
+    def iter_data(self, chunk_size=(10 * 1024 ** 2), offset=0, buffers=1):
+        # A chunk is overwritten `buffers` chunks later, callers holding more
+        # than one at a time (like prefetch) pass how many.
+        with open(self.file_path, "rb", buffering=0) as f:
+            if self.read_mode == "mmap" and hasattr(mmap, "MADV_SEQUENTIAL"):
+                yield from self._iter_mmap(f, chunk_size, offset, buffers)
+                return
+
+            f.seek(offset)
+            if self.read_mode == "fadvise" and hasattr(os, "posix_fadvise"):
+                yield from self._iter_fadvise(f, chunk_size, offset, buffers)
+            else:
+                yield from iter_readinto(f, chunk_size, buffers)
 
     def get_relative_path(self):
         return self.relative_path
@@ -23,18 +78,39 @@ class FileSystemTransferDownloadTask:
     def get_total(self):
         return os.path.getsize(self.file_path)
 
+    def get_meta(self):
+        st = os.stat(self.file_path)
+        return {"size": st.st_size, "mtime": st.st_mtime}
+
 
 class FileSystemTransferUploadTask:
     chunk_size = 10 * 1024 ** 2
     step_size = 1024 ** 2
+    prefetch = 1
+    sync = False
 
     def __init__(self, task, bar):
         self.task = task
         self.bar = bar
 
+    def _copy_local(self, total_path):
+        if not isinstance(self.task, FileSystemTransferDownloadTask):
+            return False
+        if not is_supported():
+            return False
+        copy_file(self.task.file_path, total_path, self.step_size, self.bar.update)
+        return True
+
+    def _is_same(self, total_path):
+        st = os.stat(total_path)
+        return is_same_file(
+            self.task.get_meta(), {"size": st.st_size, "mtime": st.st_mtime}
+        )
+
     def run(self, total_path):
         if os.path.exists(total_path):
-            raise TaskExistError(task=self.task)
+            if not self.sync or self._is_same(total_path):
+                raise TaskExistError(task=self.task)
         try:
             base_dir = os.path.dirname(total_path)
             if not os.path.exists(base_dir):
@@ -42,13 +118,21 @@ class FileSystemTransferUploadTask:
 
             self.bar.init_bar(self.task.get_total(), self.task.get_relative_path())
 
-            with open(total_path, "wb") as f:
-                for data in self.task.iter_data(chunk_size=self.chunk_size):
-                    while data:
-                        step = data[: self.step_size]
-                        f.write(step)
-                        data = data[self.step_size :]
-                        self.bar.update(len(step))
+            if not self._copy_local(total_path):
+                with open(total_path, "wb") as f:
+                    for data in prefetch(
+                        self.task.iter_data(
+                            chunk_size=self.chunk_size, buffers=self.prefetch + 1
+                        ),
+                        self.prefetch,
+                    ):
+                        for step in DataIter(data, self.step_size, self.bar):
+                            f.write(step)
+
+            # Keep the source mtime so later --sync runs can compare it.
+            mtime = self.task.get_meta().get("mtime")
+            if mtime:
+                os.utime(total_path, (mtime, mtime))
         except Exception as e:
             raise TaskFailError(task=self.task, msg=str(e), code=type(e))
         finally:
@@ -56,8 +140,9 @@ class FileSystemTransferUploadTask:
 
 
 class FileSystemTransferManager:
-    def __init__(self, path):
+    def __init__(self, path, read_mode="buffered"):
         self.path = path
+        self.read_mode = read_mode
 
     def _iter_localpaths(self):
         base_path, _ = os.path.split(self.path)
@@ -69,11 +154,13 @@ class FileSystemTransferManager:
     def get_transfer(cls, conf, path, args):
         FileSystemTransferUploadTask.chunk_size = args.chunk_size
         FileSystemTransferUploadTask.step_size = args.step_size
-        return cls(path=path)
+        FileSystemTransferUploadTask.prefetch = args.prefetch
+        FileSystemTransferUploadTask.sync = args.sync
+        return cls(path=path, read_mode=conf.get("read_mode", "buffered"))
 
     def iter_tasks(self):
         for l, r in self._iter_localpaths():
-            yield FileSystemTransferDownloadTask(l, r)
+            yield FileSystemTransferDownloadTask(l, r, self.read_mode)
 
     def get_worker(self, task):
         total_path = norm_path(self.path, task.get_relative_path())
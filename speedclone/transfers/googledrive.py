@@ -1,35 +1,73 @@
+import asyncio
 import os
 import random
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
 from json.decoder import JSONDecodeError
+from threading import Condition, Lock, Thread
 
-import requests
 from requests.exceptions import HTTPError
 
+from ..buffer import prefetch
+from ..cache import DirCache, FolderIndex, ListingSnapshot, TokenCache
 from ..client.google import (
     FileSystemServiceAccountTokenBackend,
     FileSystemTokenBackend,
     GoogleDrive,
 )
-from ..error import TaskExistError, TaskFailError
-from ..utils import DataIter, console_write, iter_path, norm_path
+from ..client.pool import ClientPool
+from ..client.refresh import TokenRefresher
+from ..crawler import Crawler
+from ..error import RequestError, TaskExistError, TaskFailError
+from ..quota import QuotaLedger
+from ..ratelimit import RateLimiter
+from ..session import PooledSession, iter_ranged, merge_stats
+from ..utils import (
+    DataIter,
+    console_write,
+    is_same_file,
+    iter_path,
+    shard_paths,
+    norm_path,
+    parse_time,
+)
 
 
 class GoogleDriveTransferDownloadTask:
-    http = {}
-
-    def __init__(self, file_id, relative_path, size, client):
+    __slots__ = (
+        "file_id",
+        "relative_path",
+        "size",
+        "client",
+        "md5",
+        "mtime",
+        "upload_session",
+    )
+    connections = 1
+
+    def __init__(self, file_id, relative_path, size, client, md5=None, mtime=None):
         self.file_id = file_id
         self.relative_path = relative_path
         self.size = size
         self.client = client
+        self.md5 = md5
+        self.mtime = mtime
 
-    def iter_data(self, chunk_size=(10 * 1024 ** 2), copy=False):
+    def iter_data(self, chunk_size=(10 * 1024 ** 2), copy=False, offset=0, buffers=1):
+        # Every chunk is a new buffer, so `buffers` needs no handling.
         if copy:
             yield self.file_id
         else:
-            with self.client.get_download_request(self.file_id) as r:
-                r.raise_for_status()
-                yield from r.iter_content(chunk_size=chunk_size)
+            yield from iter_ranged(
+                lambda headers: self.client.get_download_request(self.file_id, headers),
+                self.size,
+                chunk_size,
+                self.connections,
+                offset,
+            )
 
     def get_relative_path(self):
         return self.relative_path
@@ -37,11 +75,23 @@ class GoogleDriveTransferDownloadTask:
     def get_total(self):
         return self.size
 
+    def get_meta(self):
+        return {"size": self.size, "md5": self.md5, "mtime": self.mtime}
+
+    def __getstate__(self):
+        # Clients hold sessions and locks, another process binds its own.
+        return {k: getattr(self, k, None) for k in self.__slots__ if k != "client"}
+
+    def __setstate__(self, state):
+        self.client = None
+        for k, v in state.items():
+            setattr(self, k, v)
+
 
 class GoogleDriveTransferUploadTask:
     chunk_size = 10 * 1024 ** 2
     step_size = 1024 ** 2
-    http = {}
+    prefetch = 1
 
     def __init__(self, task, bar, client):
         self.task = task
@@ -49,14 +99,12 @@ class GoogleDriveTransferUploadTask:
         self.client = client
 
     def _handle_request_error(self, request):
-        if request.status_code == 429:
-            sleep_time = request.headers.get("Retry-After")
-            seconds = self.client.sleep(sleep_time)
-            raise Exception("Client Limit Exceeded. Sleep for {}s".format(seconds))
-
-        if request.status_code == 400 and "LimitExceeded" in request.text:
-            seconds = self.client.sleep()
-            raise Exception("Client Limit Exceeded. Sleep for {}s".format(seconds))
+        if self.client.is_throttled(request):
+            raise Exception(
+                "Client Limit Exceeded. Retry in {:.0f}s".format(
+                    self.client.limiter.get_delay()
+                )
+            )
 
         try:
             request.raise_for_status()
@@ -68,9 +116,12 @@ class GoogleDriveTransferUploadTask:
                 )
             except JSONDecodeError:
                 message = "No json response returned."
-            raise Exception("HttpError {}: {}".format(status_code, message))
+            raise RequestError(
+                status_code, "HttpError {}: {}".format(status_code, message)
+            )
 
-    def _do_copy(self, folder_id, name):
+    def _do_copy(self, folder_id, name, check=True, file_id=None):
+        # A copy always creates a new file, `file_id` is not replaced.
         if self.client.sleeping:
             raise TaskFailError(
                 task=self.task, msg="Client is sleeping, will retry later."
@@ -80,7 +131,7 @@ class GoogleDriveTransferUploadTask:
             file_size = self.task.get_total()
             self.bar.init_bar(file_size, self.task.get_relative_path())
             for file_id in self.task.iter_data(copy=True):
-                result = self.client.copy_to(file_id, folder_id, name)
+                result = self.client.copy_to(file_id, folder_id, name, check)
                 if result is not False:
                     self._handle_request_error(result)
         except Exception as e:
@@ -88,37 +139,94 @@ class GoogleDriveTransferUploadTask:
         else:
             if result is False:
                 raise TaskExistError(task=self.task)
+            return result.json()
         finally:
             self.bar.update(file_size)
             self.bar.close()
 
-    def run(self, folder_id, name):
+    def _query_session(self, upload_url, file_size):
+        # Ask a saved session how much it already has. Returns the next offset
+        # and the file when the upload turned out to be complete, or None for
+        # an expired session.
+        headers = {
+            "Content-Range": "bytes */{}".format(file_size),
+            "Content-Length": "0",
+        }
+        r = self.client.request("PUT", upload_url, headers=headers)
+
+        if r.status_code == 308:
+            header_range = r.headers.get("Range")
+            if not header_range:
+                return 0, None
+            return int(header_range.rsplit("-", 1)[1]) + 1, None
+
+        if r.status_code in (200, 201):
+            return file_size, r.json()
+
+        if r.status_code in (404, 410):
+            return None, None
+
+        self._handle_request_error(r)
+        return None, None
+
+    def run(self, folder_id, name, check=True, file_id=None):
         if self.client.sleeping:
             raise TaskFailError(
                 task=self.task, msg="Client is sleeping, will retry later."
             )
 
-        try:
-            upload_url_request = self.client.get_upload_url(folder_id, name)
-        except Exception as e:
-            raise TaskFailError(exce=e, task=self.task, msg=str(e))
-        else:
-            if upload_url_request is False:
-                raise TaskExistError(task=self.task)
+        file_size = self.task.get_total()
+        upload_url = getattr(self.task, "upload_session", None)
+        offset = 0
 
-        try:
-            self._handle_request_error(upload_url_request)
+        if upload_url:
+            try:
+                offset, result = self._query_session(upload_url, file_size)
+            except Exception as e:
+                raise TaskFailError(exce=e, task=self.task, msg=str(e))
+            if result is not None:
+                self.task.upload_session = None
+                return result
+            if offset is None:
+                upload_url, offset = None, 0
+
+        if not upload_url:
+            try:
+                upload_url_request = self.client.get_upload_url(
+                    folder_id,
+                    name,
+                    check,
+                    file_id=file_id,
+                    mtime=self.task.get_meta().get("mtime"),
+                )
+            except Exception as e:
+                raise TaskFailError(exce=e, task=self.task, msg=str(e))
+            else:
+                if upload_url_request is False:
+                    raise TaskExistError(task=self.task)
+
+            try:
+                self._handle_request_error(upload_url_request)
+            except Exception as e:
+                raise TaskFailError(exce=e, task=self.task, msg=str(e))
             upload_url = upload_url_request.headers.get("Location")
-            file_size = self.task.get_total()
+            self.task.upload_session = upload_url
 
+        try:
             self.bar.init_bar(file_size, self.task.get_relative_path())
+            self.bar.update(offset)
 
-            for i, file_piece in enumerate(
-                self.task.iter_data(chunk_size=self.chunk_size)
+            for file_piece in prefetch(
+                self.task.iter_data(
+                    chunk_size=self.chunk_size,
+                    offset=offset,
+                    buffers=self.prefetch + 1,
+                ),
+                self.prefetch,
             ):
                 chunk_length = len(file_piece)
 
-                start = i * self.chunk_size
+                start = offset
                 end = start + chunk_length - 1
                 headers = {
                     "Content-Range": "bytes {}-{}/{}".format(start, end, file_size),
@@ -127,9 +235,7 @@ class GoogleDriveTransferUploadTask:
 
                 data = DataIter(file_piece, self.step_size, self.bar)
 
-                r = requests.put(
-                    upload_url, data=data, headers=headers, **self.client.http
-                )
+                r = self.client.request("PUT", upload_url, data=data, headers=headers)
 
                 self._handle_request_error(r)
 
@@ -137,57 +243,408 @@ class GoogleDriveTransferUploadTask:
                     header_range = r.headers.get("Range")
                     if not header_range or header_range.lstrip("bytes=0-") != str(end):
                         raise Exception("Upload Error: Range missing")
+                    offset = end + 1
 
                 elif "id" not in r.json().keys():
                     raise Exception("Upload Error: Upload not successful")
 
+                else:
+                    self.task.upload_session = None
+                    return r.json()
+
         except Exception as e:
             raise TaskFailError(exce=e, task=self.task, msg=str(e))
         finally:
             self.bar.close()
 
+    def _read_into(self, view):
+        # Sources may reuse their buffers, copy each piece out.
+        filled = 0
+        for piece in self.task.iter_data(chunk_size=self.chunk_size):
+            end = filled + len(piece)
+            if end > len(view):
+                raise Exception("File changed while reading")
+            view[filled:end] = piece
+            filled = end
+        if filled != len(view):
+            raise Exception("File changed while reading")
+
+    async def run_async(self, folder_id, name, file_id=None):
+        # Single request upload of a small file on the asyncio engine.
+        if self.client.sleeping:
+            raise TaskFailError(
+                task=self.task, msg="Client is sleeping, will retry later."
+            )
+
+        try:
+            file_size = self.task.get_total()
+            boundary, body, content = self.client.get_multipart_body(
+                folder_id,
+                name,
+                file_size,
+                file_id=file_id,
+                mtime=self.task.get_meta().get("mtime"),
+            )
+            await asyncio.to_thread(self._read_into, content)
+            content.release()
+            self.bar.init_bar(file_size, self.task.get_relative_path())
+
+            r = await self.client.upload_async(boundary, body, file_id=file_id)
+            self._handle_request_error(r)
+            self.bar.update(file_size)
+            return r.json()
+
+        except Exception as e:
+            raise TaskFailError(exce=e, task=self.task, msg=str(e))
+        finally:
+            self.bar.close()
+
+
+class GoogleDriveCopyBatcher:
+    batch_size = 100
+    batch_workers = 2
+    flush_interval = 0.5
+    max_attempts = 5
+
+    def __init__(self, get_client, batch_size=None):
+        self.get_client = get_client
+        self.batch_size = min(batch_size or self.batch_size, 100)
+        self.max_pending = self.batch_size * self.batch_workers * 2
+        self.cond = Condition()
+        self.items = deque()
+        self.pending = 0
+        self.threads = []
+
+    def submit(self, source_id, dest_id, name):
+        # Waits while `max_pending` copies are unsettled, so the workers, and
+        # the listing behind them, cannot run ahead of the batches.
+        with self.cond:
+            while self.pending >= self.max_pending:
+                self.cond.wait()
+            self.pending += 1
+        future = Future()
+        self._put([source_id, dest_id, name, future, 0])
+        return future
+
+    def _settle(self, item, result=None, error=None):
+        with self.cond:
+            self.pending -= 1
+            self.cond.notify_all()
+        if error is not None:
+            item[3].set_exception(error)
+        else:
+            item[3].set_result(result)
+
+    def _put(self, item):
+        with self.cond:
+            self.items.append(item)
+            if not self.threads:
+                for _ in range(self.batch_workers):
+                    t = Thread(target=self._run, daemon=True)
+                    t.start()
+                    self.threads.append(t)
+            # Submitters wait on `cond` as well.
+            self.cond.notify_all()
+
+    def _take(self):
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+            deadline = time.monotonic() + self.flush_interval
+            while len(self.items) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            size = min(self.batch_size, len(self.items))
+            return [self.items.popleft() for _ in range(size)]
+
+    def _retry(self, item, error):
+        item[4] += 1
+        if item[4] >= self.max_attempts:
+            self._settle(item, error=error)
+        else:
+            self._put(item)
+
+    def _send(self, batch):
+        client = self.get_client()
+        replies = client.batch(
+            [
+                (
+                    "POST",
+                    "{}/copy".format(source_id),
+                    {"supportsAllDrives": "true", "fields": GoogleDrive.file_fields},
+                    {"name": name, "parents": [dest_id]},
+                )
+                for source_id, dest_id, name, _, _ in batch
+            ]
+        )
+
+        limited = False
+        for i, item in enumerate(batch):
+            if i not in replies:
+                self._retry(item, Exception("Batch Error: Missing response"))
+                continue
+
+            status_code, reply = replies[i]
+            if status_code == 200:
+                self._settle(item, reply)
+                continue
+
+            message = reply.get("error", {}).get("message", "Empty message")
+            error = RequestError(
+                status_code, "HttpError {}: {}".format(status_code, message)
+            )
+            if GoogleDrive.is_rate_limited(status_code, str(reply)):
+                limited = True
+                self._retry(item, error)
+            else:
+                self._settle(item, error=error)
+
+        if limited:
+            client.throttle()
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            try:
+                self._send(batch)
+            except Exception as e:
+                for item in batch:
+                    self._retry(item, e)
+
 
 class GoogleDriveTransferManager:
     max_page_size = 100
-
-    def __init__(self, path, clients, root):
+    dir_workers = 5
+    index_folders = 100
+    index_max_files = 10000
+    list_workers = 4
+    list_retries = 3
+    copy_batch_size = 0
+    copy = False
+    sync = False
+    replace = False
+    quota_retry = 60
+    async_max_size = 4 * 1024 ** 2
+    async_memory = 256 * 1024 ** 2
+
+    def __init__(
+        self, path, clients, root, dir_cache=None, snapshot_path=None, quota=None
+    ):
         self.path = path
         self.clients = clients
-        self.dir_cache = {"": root}
-        self.list_files_set = set()
+        self.pool = ClientPool(clients)
+        self.quota = quota
+        self.snapshot_path = snapshot_path
+        self.snapshot = None
+        self.next_page_token = None
+        self.dir_cache = dir_cache or DirCache(root)
+        self.dir_lock = Lock()
+        self.dir_futures = {}
+        self.dir_jobs = {}
+        self.dir_executor = None
+        self.folder_index = FolderIndex(
+            self._list_folder_files, self.index_folders, self.index_max_files
+        )
+        self.copy_batcher = GoogleDriveCopyBatcher(
+            self._get_client, self.copy_batch_size
+        )
         self.root_path, self.base_name = os.path.split(self.path)
+        # File bytes held by uploads on the event loop, see _hold_memory.
+        self.async_bytes = 0
+        self.async_cond = None
 
     def _get_client(self):
-        while True:
-            client = self.clients.pop(0)
-            self.clients.append(client)
-            if client.sleeping:
-                continue
+        return self.pool.get()
+
+    def _reserve_quota(self, size, client):
+        return self.quota.reserve(client.account, size)
+
+    def _get_upload_client(self, size, wait=True):
+        # The least loaded account with `size` bytes of daily quota left, which
+        # are reserved. None when no account has them.
+        reserve = partial(self._reserve_quota, size) if self.quota else None
+        return self.pool.acquire(size, reserve, wait)
+
+    def _get_quota_wait(self, size):
+        # Until the first account has room again, but retry now and then. The
+        # ledger knows every account the pool just tried, asking the clients
+        # would load the credentials of all of them.
+        delay = self.quota.get_min_delay(size)
+        return self.quota_retry if delay is None else min(delay, self.quota_retry)
+
+    def _finish_upload(self, client, size, ok):
+        self.pool.release(client, size)
+        if self.quota:
+            # Count the bytes once the upload went through.
+            if ok:
+                self.quota.commit(client.account, size)
             else:
-                return client
+                self.quota.release(client.account, size)
+
+    def _settle_upload(self, client, size, future):
+        ok = not future.cancelled() and not future.exception()
+        self._finish_upload(client, size, ok)
+
+    def _run_upload(self, client, size, upload):
+        try:
+            result = upload()
+        except BaseException:
+            self._finish_upload(client, size, False)
+            raise
+        if isinstance(result, Future):
+            result.add_done_callback(partial(self._settle_upload, client, size))
+        else:
+            self._finish_upload(client, size, True)
+        return result
 
-    def _get_dir_id(self, path):
+    def _get_dir_id(self, path, retry=True):
         client = self._get_client()
 
         parent_path, name = os.path.split(path)
         parent_id = self._get_cache_dir_id(parent_path)
 
-        has_folder = (
-            client.get_files_by_name(parent_id, name, fields=("files/id",))
-            .json()
-            .get("files")
-        )
+        r = client.get_files_by_name(parent_id, name, fields=("files/id",))
+        if r.status_code == 404 and parent_path and retry:
+            # The cached parent was deleted or moved, resolve it again.
+            self.dir_cache.pop(parent_path)
+            return self._get_dir_id(path, retry=False)
+        r.raise_for_status()
+        has_folder = r.json().get("files")
 
         if has_folder:
             folder_id = has_folder[0].get("id")
         else:
-            folder_id = client.create_file_by_name(parent_id, name).json().get("id")
+            r = client.create_file_by_name(parent_id, name)
+            r.raise_for_status()
+            folder_id = r.json()["id"]
+            self.folder_index.seed(folder_id)
 
         self.dir_cache[path] = folder_id
         return folder_id
 
     def _get_cache_dir_id(self, path):
-        return self.dir_cache.get(path) or self._get_dir_id(path)
+        dir_id = self.dir_cache.get(path)
+        if dir_id:
+            return dir_id
+
+        # Single flight: only one thread creates a path, the others wait on it.
+        with self.dir_lock:
+            dir_id = self.dir_cache.get(path)
+            if dir_id:
+                return dir_id
+            future = self.dir_futures.get(path)
+            owner = future is None
+            if owner:
+                future = self.dir_futures[path] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            dir_id = self._get_dir_id(path)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(dir_id)
+            return dir_id
+        finally:
+            with self.dir_lock:
+                self.dir_futures.pop(path, None)
+
+    def _resolve_dir(self, path):
+        dir_id = self.dir_cache.get(path)
+        if dir_id:
+            future = Future()
+            future.set_result(dir_id)
+            return future
+
+        with self.dir_lock:
+            future = self.dir_jobs.get(path)
+            if future is not None:
+                return future
+            if self.dir_executor is None:
+                self.dir_executor = ThreadPoolExecutor(max_workers=self.dir_workers)
+            future = self.dir_executor.submit(self._get_cache_dir_id, path)
+            self.dir_jobs[path] = future
+
+        future.add_done_callback(lambda f: self._resolve_done(path, f))
+        return future
+
+    def _resolve_done(self, path, future):
+        with self.dir_lock:
+            if self.dir_jobs.get(path) is future:
+                del self.dir_jobs[path]
+
+    def _list_folder_files(self, dir_id, max_files):
+        client = self._get_client()
+        files = {}
+        p = {
+            "q": " and ".join(
+                [
+                    "'{parent_id}' in parents",
+                    "mimeType != 'application/vnd.google-apps.folder'",
+                    "trashed = false",
+                ]
+            ).format(parent_id=dir_id),
+            "pageSize": 1000,
+            "fields": "nextPageToken, files(id, name, size, md5Checksum, modifiedTime)",
+        }
+        while True:
+            r = client.get_files_by_p(p)
+            r.raise_for_status()
+            result = r.json()
+            for file in result.get("files", []):
+                old = files.get(file["name"])
+                if old is None or self._is_newer(file, old):
+                    files[file["name"]] = file
+            if len(files) > max_files:
+                return None
+
+            next_token = result.get("nextPageToken")
+            if not next_token:
+                return files
+            p["pageToken"] = next_token
+
+    def _find_file(self, client, dir_id, name):
+        files = self.folder_index.get(dir_id)
+        if files is not None:
+            return files.get(name)
+
+        r = client.get_files_by_name(
+            dir_id,
+            name,
+            mime="file",
+            fields=(
+                "files/id",
+                "files/size",
+                "files/md5Checksum",
+                "files/modifiedTime",
+            ),
+        )
+        r.raise_for_status()
+        files = r.json().get("files", [])
+        newest = None
+        for file in files:
+            if newest is None or self._is_newer(file, newest):
+                newest = file
+        return newest
+
+    def _is_newer(self, file, other):
+        # --sync without --replace leaves the old copy of a changed file next
+        # to the new one, compare against the newest of same named files.
+        # Drive's RFC 3339 times all have the same format, so they sort as
+        # strings.
+        return file.get("modifiedTime", "") > other.get("modifiedTime", "")
+
+    def _get_meta(self, file):
+        return {
+            "size": int(file.get("size", 0)),
+            "md5": file.get("md5Checksum"),
+            "mtime": parse_time(file.get("modifiedTime")),
+        }
 
     def _get_root_name(self):
         client = self._get_client()
@@ -204,84 +661,259 @@ class GoogleDriveTransferManager:
                 parent_dir_id,
                 name,
                 mime="file",
-                fields=("files/id", "files/name", "files/mimeType", "files/size"),
+                fields=(
+                    "files/id",
+                    "files/name",
+                    "files/mimeType",
+                    "files/size",
+                    "files/md5Checksum",
+                    "files/modifiedTime",
+                ),
             )
             .json()
             .get("files", [])
         )
         for i in is_file:
-            yield i.get("id", ""), i.get("name", ""), int(i.get("size", 0))
+            yield (
+                i.get("id", ""),
+                i.get("name", ""),
+                int(i.get("size", 0)),
+                i.get("md5Checksum"),
+                parse_time(i.get("modifiedTime")),
+            )
 
-    def _list_dirs(self, path, page_token=None, client=None):
-        try:
-            client = client or self._get_client()
+    def _list_page(self, job):
+        path, dir_id, page_token = job
+        client = self._get_client()
 
-            abs_path = norm_path(self.root_path, path)
-            dir_id = self._get_cache_dir_id(abs_path)
+        p = {
+            "q": " and ".join(["'{parent_id}' in parents", "trashed = false"]).format(
+                parent_id=dir_id
+            ),
+            "pageSize": self.max_page_size,
+            "fields": ", ".join(
+                (
+                    "nextPageToken",
+                    "files/id",
+                    "files/name",
+                    "files/size",
+                    "files/mimeType",
+                    "files/md5Checksum",
+                    "files/modifiedTime",
+                )
+            ),
+        }
 
-            p = {
-                "q": " and ".join(
-                    ["'{parent_id}' in parents", "trashed = false"]
-                ).format(parent_id=dir_id),
-                "pageSize": self.max_page_size,
-                "fields": ", ".join(
+        if page_token:
+            p.update({"pageToken": page_token})
+
+        r = client.get_files_by_p(p)
+        r.raise_for_status()
+        result = r.json()
+
+        items = []
+        folders = []
+        nodes = []
+
+        for file in result.get("files", []):
+            relative_path = norm_path(path, file.get("name", ""))
+            if file["mimeType"] == "application/vnd.google-apps.folder":
+                folders.append((relative_path, file["id"], None))
+            else:
+                file_id = file.get("id", "")
+                file_path = norm_path(self.root_name, relative_path)
+                file_size = int(file.get("size", 0))
+                items.append(
                     (
-                        "nextPageToken",
-                        "files/id",
-                        "files/name",
-                        "files/size",
-                        "files/mimeType",
+                        file_id,
+                        file_path,
+                        file_size,
+                        file.get("md5Checksum"),
+                        parse_time(file.get("modifiedTime")),
                     )
-                ),
-            }
+                )
+            nodes.append(self._get_node(file, dir_id))
+
+        if self.snapshot is not None:
+            self.snapshot.add(nodes)
+
+        next_token = result.get("nextPageToken")
+        next_page = (path, dir_id, next_token) if next_token else None
+
+        return items, next_page, folders
+
+    def _list_dirs(self, path):
+        dir_id = self._get_cache_dir_id(norm_path(self.root_path, path))
+        crawler = Crawler(self._list_page, self.list_workers, self.list_retries)
+        yield from crawler.crawl([(path, dir_id, None)])
+
+    def _get_node(self, file, parent_id):
+        return (
+            file["id"],
+            parent_id,
+            file.get("name", ""),
+            file["mimeType"] == "application/vnd.google-apps.folder",
+            int(file.get("size", 0)),
+            file.get("md5Checksum"),
+            file.get("modifiedTime"),
+        )
 
-            if page_token:
-                p.update({"pageToken": page_token})
+    def _list_changes(self, path, page_token):
+        # Replay the changes feed and yield the files added or modified below
+        # `path`. Folders moved in from elsewhere bring no changes for their
+        # content, so they are crawled, along with the ones an interrupted
+        # run left pending. Returns the next cursor.
+        client = self._get_client()
+        fields = (
+            "nextPageToken, newStartPageToken, changes(fileId, removed, "
+            "file(id, name, size, md5Checksum, modifiedTime, mimeType, parents, "
+            "trashed))"
+        )
+        seen = set()
+        new_folders = self.snapshot.get_pending()
 
-            r = client.get_files_by_p(p)
+        while True:
+            r = client.get_changes(page_token, fields, 1000)
+            r.raise_for_status()
             result = r.json()
 
-            folders = []
-
-            for file in result.get("files", []):
-                relative_path = norm_path(path, file.get("name", ""))
-                if file["mimeType"] == "application/vnd.google-apps.folder":
-                    folders.append(relative_path)
+            files = []
+            removed = []
+            found = []
+            for change in result.get("changes", []):
+                file = change.get("file")
+                if change.get("removed") or not file or file.get("trashed"):
+                    removed.append(change["fileId"])
+                elif not file.get("parents"):
+                    removed.append(file["id"])
+                elif file["mimeType"] == "application/vnd.google-apps.folder":
+                    if file["id"] not in self.snapshot.folders:
+                        found.append(file["id"])
+                    self.snapshot.set_folder(
+                        file["id"], file["parents"][0], file.get("name", "")
+                    )
+                    files.append(file)
                 else:
-                    file_id = file.get("id", "")
-                    file_path = norm_path(self.root_name, relative_path)
-                    file_size = int(file.get("size", 0))
+                    files.append(file)
+
+            # Before their nodes are stored, which hides them from a rerun.
+            self.snapshot.add_pending(found)
+            new_folders.extend(found)
+            self.snapshot.remove(removed)
+
+            nodes = []
+            outside = []
+            for file in files:
+                parent_id = file["parents"][0]
+                parent_path = self.snapshot.path(parent_id)
+                if parent_path is None:
+                    outside.append(file["id"])
+                    continue
+
+                node = self._get_node(file, parent_id)
+                nodes.append(node)
+                if node[3] or file["id"] in seen:
+                    continue
+                seen.add(file["id"])
+                relative_path = norm_path(path, parent_path, node[2])
+                yield (
+                    file["id"],
+                    norm_path(self.root_name, relative_path),
+                    node[4],
+                    node[5],
+                    parse_time(node[6]),
+                )
 
-                    item = (file_id, file_path, file_size)
-                    if item not in self.list_files_set:
-                        self.list_files_set.add(item)
-                        yield item
+            self.snapshot.add(nodes)
+            self.snapshot.remove(outside)
 
             next_token = result.get("nextPageToken")
+            if not next_token:
+                page_token = result.get("newStartPageToken")
+                break
+            page_token = next_token
+
+        jobs = []
+        for folder_id in dict.fromkeys(new_folders):
+            folder_path = self.snapshot.path(folder_id)
+            if folder_path is not None:
+                jobs.append((norm_path(path, folder_path), folder_id, None))
+        # Nested folders are reached through their top-most new ancestor.
+        jobs.sort()
+        top = []
+        for job in jobs:
+            if not any(job[0].startswith(t[0] + "/") for t in top):
+                top.append(job)
+
+        crawler = Crawler(self._list_page, self.list_workers, self.list_retries)
+        for item in crawler.crawl(top):
+            if item[0] not in seen:
+                seen.add(item[0])
+                yield item
+
+        if crawler.failed:
+            return None
+        return page_token
+
+    def _list_snapshot(self, path):
+        dir_id = self._get_cache_dir_id(norm_path(self.root_path, path))
+        client = self._get_client()
+        self.snapshot = ListingSnapshot(self.snapshot_path, client.drive, dir_id)
 
-            if next_token:
-                yield from self._list_dirs(path, next_token, client)
-
-            for folder_path in folders:
-                yield from self._list_dirs(folder_path)
-
-        except Exception as e:
-            console_write(mode="error", message="{}: {}".format(path, str(e)))
-            yield from self._list_dirs(path)
+        page_token = self.snapshot.get_token()
+        if page_token:
+            page_token = yield from self._list_changes(path, page_token)
+        else:
+            # Take the cursor first so changes made during the crawl replay.
+            r = client.get_start_page_token()
+            r.raise_for_status()
+            page_token = r.json()["startPageToken"]
+
+            self.snapshot.clear()
+            crawler = Crawler(self._list_page, self.list_workers, self.list_retries)
+            yield from crawler.crawl([(path, dir_id, None)])
+            if crawler.failed:
+                page_token = None
+
+        if page_token:
+            self.next_page_token = page_token
+        else:
+            console_write(mode="error", message="Listing incomplete, snapshot kept.")
 
     @classmethod
     def get_transfer(cls, conf, path, args):
 
         GoogleDriveTransferUploadTask.chunk_size = args.chunk_size
         GoogleDriveTransferUploadTask.step_size = args.step_size
+        GoogleDriveTransferUploadTask.prefetch = args.prefetch
+        GoogleDriveTransferDownloadTask.connections = args.download_connections
         GoogleDrive.sleep_time = args.sleep
+        RateLimiter.rate = args.rate
+        RateLimiter.max_rate = args.max_rate
         cls.max_page_size = args.max_page_size
+        cls.dir_workers = args.workers
+        cls.index_folders = args.index_folders
+        cls.index_max_files = args.index_max_files
+        cls.list_workers = args.list_workers
+        cls.list_retries = args.list_retries
+        cls.sync = args.sync
+        cls.replace = args.replace
+        cls.async_max_size = args.async_max_size
+        cls.async_memory = args.async_memory
+        quota = (
+            QuotaLedger(args.daily_quota, conf.get("quota"))
+            if args.daily_quota
+            else None
+        )
 
         if args.copy:
             GoogleDriveTransferUploadTask.run = GoogleDriveTransferUploadTask._do_copy
+            cls.copy = True
+            cls.copy_batch_size = args.copy_batch_size
 
+        PooledSession.pool_maxsize = args.workers + args.large_workers
         GoogleDrive.http = conf.get("http", {})
-        FileSystemTokenBackend.http = conf.get("http", {})
+        FileSystemTokenBackend.session = PooledSession(conf.get("http", {}))
 
         token_path = conf.get("token_path")
 
@@ -289,6 +921,8 @@ class GoogleDriveTransferManager:
             use_service_account = conf.get("service_account", False)
 
             root = conf.get("root")
+            cache_path = conf.get("dir_cache")
+            snapshot_path = conf.get("snapshot")
 
             if conf.get("use_root_in_path"):
                 _path = path.split("/")
@@ -297,53 +931,252 @@ class GoogleDriveTransferManager:
 
             drive = conf.get("drive_id")
             cred = conf.get("client")
+            token_cache = conf.get("token_cache")
+            if token_cache:
+                token_cache = TokenCache(token_cache)
 
             clients = []
 
-            for p in iter_path(token_path):
+            for p in shard_paths(iter_path(token_path), args.shard):
                 if use_service_account:
-                    token_backend = FileSystemServiceAccountTokenBackend(cred_path=p)
+                    token_backend = FileSystemServiceAccountTokenBackend(
+                        cred_path=p, cache=token_cache
+                    )
                 else:
                     token_backend = FileSystemTokenBackend(cred=cred, token_path=p)
                 client = GoogleDrive(token_backend=token_backend, drive=drive)
                 clients.append(client)
 
+            if not clients:
+                raise Exception("No account left for this process, use fewer.")
+
+            TokenRefresher(
+                (client.token_backend for client in clients), args.token_margin
+            ).start()
             random.shuffle(clients)
-            return cls(path=path, clients=clients, root=root)
+            dir_cache = DirCache(root, db_path=cache_path, drive_id=drive)
+            return cls(
+                path=path,
+                clients=clients,
+                root=root,
+                dir_cache=dir_cache,
+                snapshot_path=snapshot_path,
+                quota=quota,
+            )
         else:
             raise Exception("Token path not exists")
 
+    def get_stats(self):
+        stats = merge_stats(client._session for client in self.clients)
+        stats["clients"] = []
+        for client in self.clients:
+            client_stats = {**client.limiter.get_stats(), **self.pool.get_stats(client)}
+            # Clients without a session were never used, reading their account
+            # would load credentials for nothing.
+            if self.quota and client._session is not None:
+                client_stats["quota_left"] = self.quota.get_remaining(client.account)
+            stats["clients"].append(client_stats)
+        return stats
+
     def iter_tasks(self):
-        for file_id, relative_path, size in self._list_files(self.path):
+        for file_id, relative_path, size, md5, mtime in self._list_files(self.path):
             yield GoogleDriveTransferDownloadTask(
-                file_id, relative_path, size, self._get_client()
+                file_id, relative_path, size, self._get_client(), md5, mtime
             )
             return
 
         self.root_name = "" if self.path else self._get_root_name()
 
-        for file_id, relative_path, size in self._list_dirs(self.base_name):
+        if self.snapshot_path:
+            files = self._list_snapshot(self.base_name)
+        else:
+            files = self._list_dirs(self.base_name)
+
+        for file_id, relative_path, size, md5, mtime in files:
             yield GoogleDriveTransferDownloadTask(
-                file_id, relative_path, size, self._get_client()
+                file_id, relative_path, size, self._get_client(), md5, mtime
             )
 
+    def bind_task(self, task):
+        task.client = self._get_client()
+
+    def resolve_dirs(self, task):
+        # Under --processes the coordinator creates the folders, so files of
+        # one new folder sent to different processes share it. Workers
+        # resolve the folder themselves when this fails.
+        dir_path = os.path.dirname(norm_path(self.path, task.get_relative_path()))
+        try:
+            return {dir_path: self._get_cache_dir_id(dir_path)}
+        except Exception:
+            return None
+
+    def add_dirs(self, dirs):
+        for path, dir_id in dirs.items():
+            if self.dir_cache.get(path) != dir_id:
+                self.dir_cache[path] = dir_id
+
+    def finish(self):
+        # Only advance the cursor once everything listed has been transferred.
+        if self.next_page_token:
+            self.snapshot.set_token(self.next_page_token)
+
+    def _copy_batched(self, task, bar, dir_path, dir_id, name):
+        file_id = next(task.iter_data(copy=True))
+        done = Future()
+
+        def callback(future):
+            file_size = task.get_total()
+            bar.init_bar(file_size, task.get_relative_path())
+            bar.update(file_size)
+            bar.close()
+            try:
+                file = future.result()
+            except Exception as e:
+                if getattr(e, "status_code", None) == 404:
+                    self.dir_cache.pop(dir_path)
+                    self.folder_index.pop(dir_id)
+                done.set_exception(TaskFailError(exce=e, task=task, msg=str(e)))
+            else:
+                self.folder_index.add(dir_id, name, file)
+                done.set_result(file)
+
+        self.copy_batcher.submit(file_id, dir_id, name).add_done_callback(callback)
+        return done
+
+    def _get_replace_id(self, task, exists):
+        # Raises TaskExistError for a file to skip, returns the id of the file
+        # to upload a new revision of.
+        if not exists:
+            return None
+        if not self.sync or is_same_file(task.get_meta(), self._get_meta(exists)):
+            raise TaskExistError(task=task)
+        return exists["id"] if self.replace else None
+
     def get_worker(self, task):
 
         total_path = norm_path(self.path, task.get_relative_path())
         dir_path, name = os.path.split(total_path)
-        try:
-            client = self._get_client()
-            dir_id = self._get_cache_dir_id(dir_path)
+        size = task.get_total()
+        dir_future = self._resolve_dir(dir_path)
 
-            def worker(bar):
-                w = GoogleDriveTransferUploadTask(task, bar, client)
-                w.run(dir_id, name)
+        def upload(client, bar):
+            try:
+                dir_id = dir_future.result()
+            except Exception as e:
+                raise TaskFailError(exce=e, task=task, msg=str(e))
 
-            return worker
-        except Exception as e:
-            _error = e
+            try:
+                exists = self._find_file(client, dir_id, name)
+            except Exception as e:
+                raise TaskFailError(exce=e, task=task, msg=str(e))
+
+            file_id = self._get_replace_id(task, exists)
+
+            if self.copy_batch_size > 1:
+                return self._copy_batched(task, bar, dir_path, dir_id, name)
+
+            w = GoogleDriveTransferUploadTask(task, bar, client)
+            try:
+                file = w.run(dir_id, name, check=False, file_id=file_id)
+            except TaskFailError as e:
+                if getattr(e.exce, "status_code", None) == 404:
+                    self.dir_cache.pop(dir_path)
+                    self.folder_index.pop(dir_id)
+                raise
+            self.folder_index.add(dir_id, name, file)
+            return file
+
+        def worker(bar):
+            # Waits here while every account is throttled.
+            client = self._get_upload_client(size)
+            if client is None:
+                time.sleep(self._get_quota_wait(size))
+                raise TaskFailError(
+                    task=task, msg="No account has daily quota left for this file."
+                )
+            return self._run_upload(client, size, partial(upload, client, bar))
+
+        return worker
 
-            def worker(bar):
-                raise TaskFailError(exce=_error, task=task, msg=str(_error))
+    def get_async_worker(self, task):
+        # Small files upload in one request on the event loop. Copies, larger
+        # and resumed uploads keep the thread worker.
+        if (
+            self.copy
+            or task.get_total()
+            > min(self.async_max_size, GoogleDriveTransferUploadTask.chunk_size)
+            or getattr(task, "upload_session", None)
+        ):
+            return None
 
-            return worker
+        total_path = norm_path(self.path, task.get_relative_path())
+        dir_path, name = os.path.split(total_path)
+        size = task.get_total()
+        client = self._get_upload_client(size, wait=False)
+        if client is None:
+            # The thread worker waits for an account.
+            return None
+        dir_future = self._resolve_dir(dir_path)
+
+        async def upload(bar):
+            try:
+                dir_id = await asyncio.wrap_future(dir_future)
+                files = self.folder_index.peek(dir_id)
+                if files is not None:
+                    exists = files.get(name)
+                else:
+                    # Listing the folder blocks, leave it to a thread.
+                    exists = await asyncio.to_thread(
+                        self._find_file, client, dir_id, name
+                    )
+            except Exception as e:
+                raise TaskFailError(exce=e, task=task, msg=str(e))
+
+            file_id = self._get_replace_id(task, exists)
+
+            w = GoogleDriveTransferUploadTask(task, bar, client)
+            try:
+                async with self._hold_memory(size):
+                    file = await w.run_async(dir_id, name, file_id=file_id)
+            except TaskFailError as e:
+                if getattr(e.exce, "status_code", None) == 404:
+                    self.dir_cache.pop(dir_path)
+                    self.folder_index.pop(dir_id)
+                raise
+            self.folder_index.add(dir_id, name, file)
+            return file
+
+        async def worker(bar):
+            try:
+                file = await upload(bar)
+            except BaseException:
+                self._finish_upload(client, size, False)
+                raise
+            self._finish_upload(client, size, True)
+            return file
+
+        return worker
+
+    @asynccontextmanager
+    async def _hold_memory(self, size):
+        # An upload on the event loop holds its whole file, at most
+        # `async_memory` bytes are held at once, or one file larger than that.
+        if self.async_cond is None:
+            self.async_cond = asyncio.Condition()
+        async with self.async_cond:
+            await self.async_cond.wait_for(
+                lambda: not self.async_bytes
+                or self.async_bytes + size <= self.async_memory
+            )
+            self.async_bytes += size
+        try:
+            yield
+        finally:
+            async with self.async_cond:
+                self.async_bytes -= size
+                self.async_cond.notify_all()
+
+    async def close_async(self):
+        self.async_cond = None
+        for client in self.clients:
+            await client.close_async()
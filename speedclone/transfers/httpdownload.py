@@ -1,34 +1,81 @@
 import os
-import requests
 from urllib.parse import unquote
 
+import requests
+
+from ..buffer import iter_chunks, skip_chunks
+from ..session import PooledSession, iter_ranged
+
 
 class HttpTransferDownloadTask:
-    http = {}
+    __slots__ = ("url", "relative_path", "_r", "size", "upload_session")
+    session = None
+    connections = 1
 
     def __init__(self, url, relative_path):
         self.url = url
         self.relative_path = relative_path
         self._r = None
+        self.size = None
 
-    def iter_data(self, chunk_size=(10 * 1024 ** 2)):
+    def iter_data(self, chunk_size=(10 * 1024 ** 2), offset=0, buffers=1):
+        # Every chunk is a new buffer, so `buffers` needs no handling.
         self.r.raise_for_status()
-        yield from self.r.iter_content(chunk_size=chunk_size)
+        size = self.get_total() or 0
+        ranges = self.r.headers.get("Accept-Ranges") == "bytes"
+        if ranges and (self.connections > 1 or offset):
+            self.r.close()
+            yield from iter_ranged(
+                lambda headers: self.session.get(
+                    self.url, headers=headers, stream=True
+                ),
+                size,
+                chunk_size,
+                self.connections,
+                offset,
+            )
+        else:
+            yield from skip_chunks(
+                iter_chunks(self.r.iter_content(chunk_size=chunk_size)), offset
+            )
 
     def get_relative_path(self):
         return self.relative_path
 
+    def get_meta(self):
+        return {"size": self.get_total()}
+
     def get_total(self):
+        # Sizing a queued task, like for the lanes, asks with HEAD instead of
+        # opening the download and holding its connection.
+        if self._r is None and self.size is None:
+            try:
+                r = self.session.head(self.url, allow_redirects=True)
+                if r.status_code == requests.codes.ok and "Content-Length" in r.headers:
+                    self.size = int(r.headers["Content-Length"])
+            except Exception:
+                pass
+        if self._r is None and self.size is not None:
+            return self.size
         try:
             if self.r.status_code == requests.codes.ok:
                 return int(self.r.headers.get("Content-Length", 0))
         except Exception:
             return 0
 
+    def __getstate__(self):
+        # The open response stays behind, the receiving process requests again.
+        return {k: getattr(self, k, None) for k in self.__slots__ if k != "_r"}
+
+    def __setstate__(self, state):
+        self._r = None
+        for k, v in state.items():
+            setattr(self, k, v)
+
     @property
     def r(self):
         if not self._r:
-            self._r = requests.get(self.url, stream=True, **self.http)
+            self._r = self.session.get(self.url, stream=True)
         return self._r
 
 
@@ -54,9 +101,14 @@ class HttpTransferManager:
     @classmethod
     def get_transfer(cls, conf, path, args):
         HttpTransferDownloadTask.chunk_size = args.chunk_size
-        HttpTransferDownloadTask.http = conf.get("http", {})
+        HttpTransferDownloadTask.connections = args.download_connections
+        PooledSession.pool_maxsize = args.workers + args.large_workers
+        HttpTransferDownloadTask.session = PooledSession(conf.get("http", {}))
         return cls(path=path)
 
+    def get_stats(self):
+        return HttpTransferDownloadTask.session.get_stats()
+
     def iter_tasks(self):
         for url, name in self._iter_urls():
             yield HttpTransferDownloadTask(url, name)
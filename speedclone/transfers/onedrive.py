@@ -2,12 +2,24 @@ import os
 import random
 from json import JSONDecodeError
 
-import requests
 from requests.exceptions import HTTPError
 
+from ..buffer import prefetch
+from ..cache import FolderIndex
 from ..client.microsoft import FileSystemTokenBackend, OneDrive
+from ..client.pool import ClientPool
+from ..client.refresh import TokenRefresher
 from ..error import TaskExistError, TaskFailError
-from ..utils import DataIter, iter_path, norm_path
+from ..ratelimit import RateLimiter
+from ..session import PooledSession, merge_stats
+from ..utils import (
+    DataIter,
+    is_same_file,
+    iter_path,
+    norm_path,
+    parse_time,
+    shard_paths,
+)
 
 
 class OneDriveTransferDownloadTask:
@@ -18,6 +30,7 @@ class OneDriveTransferDownloadTask:
 class OneDriveTransferUploadTask:
     chunk_size = 10 * 1024 ** 2
     step_size = 1024 ** 2
+    prefetch = 1
 
     def __init__(self, task, bar, client):
         self.task = task
@@ -25,10 +38,12 @@ class OneDriveTransferUploadTask:
         self.client = client
 
     def _handle_request_error(self, request):
-        if request.status_code == 429:
-            sleep_time = request.headers.get("Retry-After")
-            seconds = self.client.sleep(sleep_time)
-            raise Exception("Client Limit Exceeded. Sleep for {}s".format(seconds))
+        if self.client.is_throttled(request):
+            raise Exception(
+                "Client Limit Exceeded. Retry in {:.0f}s".format(
+                    self.client.limiter.get_delay()
+                )
+            )
 
         try:
             request.raise_for_status()
@@ -42,33 +57,69 @@ class OneDriveTransferUploadTask:
                 message = ""
             raise Exception("HttpError {}: {}".format(status_code, message))
 
-    def run(self, remote_path):
+    def _query_session(self, upload_url):
+        # Returns the next offset a saved session expects, or None when the
+        # session is gone.
+        r = self.client.request("GET", upload_url)
+        if r.status_code == 404:
+            return None
+        self._handle_request_error(r)
+        ranges = r.json().get("nextExpectedRanges")
+        if not ranges:
+            return None
+        return int(ranges[0].split("-")[0])
+
+    def run(self, remote_path, behavior="fail"):
         if self.client.sleeping:
             raise TaskFailError(
                 task=self.task, msg="Client is sleeping, will retry later."
             )
 
-        try:
-            upload_url_request = self.client.get_upload_url(remote_path)
-        except Exception as e:
-            raise TaskFailError(exce=e, task=self.task, msg=str(e))
-        else:
-            if upload_url_request is False:
-                raise TaskExistError(task=self.task)
+        upload_url = getattr(self.task, "upload_session", None)
+        offset = 0
 
-        try:
-            self._handle_request_error(upload_url_request)
+        if upload_url:
+            try:
+                offset = self._query_session(upload_url)
+            except Exception as e:
+                raise TaskFailError(exce=e, task=self.task, msg=str(e))
+            if offset is None:
+                upload_url, offset = None, 0
 
+        if not upload_url:
+            try:
+                upload_url_request = self.client.get_upload_url(
+                    remote_path, behavior, self.task.get_meta().get("mtime")
+                )
+            except Exception as e:
+                raise TaskFailError(exce=e, task=self.task, msg=str(e))
+            else:
+                if upload_url_request is False:
+                    raise TaskExistError(task=self.task)
+
+            try:
+                self._handle_request_error(upload_url_request)
+            except Exception as e:
+                raise TaskFailError(exce=e, task=self.task, msg=str(e))
             upload_url = upload_url_request.json()["uploadUrl"]
+            self.task.upload_session = upload_url
+
+        try:
             file_size = self.task.get_total()
 
             self.bar.init_bar(file_size, self.task.get_relative_path())
-
-            for i, file_piece in enumerate(
-                self.task.iter_data(chunk_size=self.chunk_size)
+            self.bar.update(offset)
+
+            for file_piece in prefetch(
+                self.task.iter_data(
+                    chunk_size=self.chunk_size,
+                    offset=offset,
+                    buffers=self.prefetch + 1,
+                ),
+                self.prefetch,
             ):
                 chunk_length = len(file_piece)
-                start = i * self.chunk_size
+                start = offset
 
                 data = DataIter(file_piece, self.step_size, self.bar)
                 headers = {
@@ -78,11 +129,15 @@ class OneDriveTransferUploadTask:
                     "Content-Length": str(chunk_length),
                 }
 
-                r = requests.put(upload_url, data=data, headers=headers,)
+                r = self.client.request("PUT", upload_url, data=data, headers=headers)
 
-                if r.status_code not in (201, 202):
+                # A replaced file finishes with 200 instead of 201.
+                if r.status_code not in (200, 201, 202):
                     self._handle_request_error(r)
                     raise Exception("Unknown Error: " + str(r))
+                offset += chunk_length
+
+            self.task.upload_session = None
 
         except Exception as e:
             raise TaskFailError(exce=e, task=self.task, msg=str(e))
@@ -91,24 +146,88 @@ class OneDriveTransferUploadTask:
 
 
 class OneDriveTransferManager:
+    index_folders = 100
+    index_max_files = 10000
+    sync = False
+    replace = False
+
     def __init__(self, path, clients):
         self.path = path
         self.clients = clients
+        self.pool = ClientPool(clients)
+        self.folder_index = FolderIndex(
+            self._list_folder_files, self.index_folders, self.index_max_files
+        )
 
     def _get_client(self):
+        return self.pool.get()
+
+    def _list_folder_files(self, dir_path, max_files):
+        client = self._get_client()
+        files = {}
+        r = client.get_children(dir_path)
         while True:
-            _client = self.clients[0]
-            self.clients = self.clients[1:] + self.clients[:1]
-            if _client.sleeping:
-                continue
-            else:
-                return _client
+            if r.status_code == 404:
+                return files
+            r.raise_for_status()
+            result = r.json()
+            for item in result.get("value", []):
+                if "file" in item:
+                    files[item["name"]] = item
+            if len(files) > max_files:
+                return None
+
+            next_link = result.get("@odata.nextLink")
+            if not next_link:
+                return files
+            r = client.get_children(dir_path, next_link)
+
+    def _find_file(self, dir_path, name):
+        # Folders too large to index are asked about the one file.
+        files = self.folder_index.get(dir_path)
+        if files is not None:
+            return files.get(name)
+
+        r = self._get_client().get_item(norm_path(dir_path, name))
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        item = r.json()
+        return item if "file" in item else None
+
+    def _get_meta(self, item):
+        return {
+            "size": item.get("size"),
+            "quickxor": item.get("file", {}).get("hashes", {}).get("quickXorHash"),
+            "mtime": parse_time(
+                item.get("fileSystemInfo", {}).get("lastModifiedDateTime")
+            ),
+        }
+
+    def _get_behavior(self, task, item):
+        # Decide how --sync treats an existing file: skip it when unchanged,
+        # otherwise replace it or upload the new one next to it.
+        if not item:
+            return "fail"
+        if is_same_file(task.get_meta(), self._get_meta(item)):
+            raise TaskExistError(task=task)
+        return "replace" if self.replace else "rename"
 
     @classmethod
     def get_transfer(cls, conf, path, args):
         OneDriveTransferUploadTask.chunk_size = args.chunk_size
         OneDriveTransferUploadTask.step_size = args.step_size
+        OneDriveTransferUploadTask.prefetch = args.prefetch
         OneDrive.sleep_time = args.sleep
+        RateLimiter.rate = args.rate
+        RateLimiter.max_rate = args.max_rate
+        OneDrive.http = conf.get("http", {})
+        PooledSession.pool_maxsize = args.workers + args.large_workers
+        FileSystemTokenBackend.session = PooledSession(conf.get("http", {}))
+        cls.index_folders = args.index_folders
+        cls.index_max_files = args.index_max_files
+        cls.sync = args.sync
+        cls.replace = args.replace
 
         token_path = conf.get("token_path")
         if os.path.exists(token_path):
@@ -117,34 +236,54 @@ class OneDriveTransferManager:
 
             clients = []
 
-            for p in iter_path(token_path):
+            for p in shard_paths(iter_path(token_path), args.shard):
                 token_backend = FileSystemTokenBackend(cred=cred, token_path=p)
                 client = OneDrive(token_backend=token_backend, drive=drive)
                 clients.append(client)
 
+            if not clients:
+                raise Exception("No account left for this process, use fewer.")
+
+            TokenRefresher(
+                (client.token_backend for client in clients), args.token_margin
+            ).start()
             random.shuffle(clients)
             return cls(path=path, clients=clients)
         else:
             raise Exception("Token path not exists")
 
+    def get_stats(self):
+        stats = merge_stats(client._session for client in self.clients)
+        stats["clients"] = [
+            {**client.limiter.get_stats(), **self.pool.get_stats(client)}
+            for client in self.clients
+        ]
+        return stats
+
     def iter_tasks(self):
         pass
 
     def get_worker(self, task):
 
         total_path = norm_path(self.path, task.get_relative_path())
-        try:
-            client = self._get_client()
-
-            def worker(bar):
+        dir_path, name = os.path.split(total_path)
+        size = task.get_total()
+
+        def worker(bar):
+            behavior = "fail"
+            if self.sync:
+                try:
+                    item = self._find_file(dir_path, name)
+                except Exception as e:
+                    raise TaskFailError(exce=e, task=task, msg=str(e))
+                behavior = self._get_behavior(task, item)
+
+            # Waits here while every account is throttled.
+            client = self.pool.acquire(size)
+            try:
                 w = OneDriveTransferUploadTask(task, bar, client)
-                w.run(total_path)
-
-            return worker
-        except Exception as e:
-            _error = e
-
-            def worker(bar):
-                raise TaskFailError(exce=_error, task=task, msg=str(_error))
+                w.run(total_path, behavior)
+            finally:
+                self.pool.release(client, size)
 
-            return worker
+        return worker
@@ -1,12 +1,12 @@
 from urllib.parse import parse_qs, unquote
 
-import requests
-
+from ..session import PooledSession, iter_ranged
 from ..utils import console_write
 
 
 class OneDriveShareTransferDownloadTask:
-    http = {}
+    __slots__ = ("url", "relative_path", "size", "s", "upload_session")
+    connections = 1
 
     def __init__(self, url, relative_path, size, session):
         self.url = url
@@ -14,10 +14,15 @@ class OneDriveShareTransferDownloadTask:
         self.size = size
         self.s = session
 
-    def iter_data(self, chunk_size=(10 * 1024 ** 2)):
-        with self.s.get(self.url, stream=True, **self.http) as r:
-            r.raise_for_status()
-            yield from r.iter_content(chunk_size=chunk_size)
+    def iter_data(self, chunk_size=(10 * 1024 ** 2), offset=0, buffers=1):
+        # Every chunk is a new buffer, so `buffers` needs no handling.
+        yield from iter_ranged(
+            lambda headers: self.s.get(self.url, headers=headers, stream=True),
+            self.size,
+            chunk_size,
+            self.connections,
+            offset,
+        )
 
     def get_relative_path(self):
         return self.relative_path
@@ -25,6 +30,18 @@ class OneDriveShareTransferDownloadTask:
     def get_total(self):
         return self.size
 
+    def get_meta(self):
+        return {"size": self.size}
+
+    def __getstate__(self):
+        # The session is not sent along, the receiving process binds its own.
+        return {k: getattr(self, k, None) for k in self.__slots__ if k != "s"}
+
+    def __setstate__(self, state):
+        self.s = None
+        for k, v in state.items():
+            setattr(self, k, v)
+
 
 class OneDriveShareTransferManager:
     headers = {"Content-Type": "application/json;odata=verbose"}
@@ -45,10 +62,10 @@ class OneDriveShareTransferManager:
         "</View>"
     )
 
-    def __init__(self, path, is_folder):
+    def __init__(self, path, is_folder, http=None):
         self.path = path
         self.is_folder = is_folder
-        self.s = requests.Session()
+        self.s = PooledSession(http)
 
         split_url = self.path.lstrip("http://").lstrip("https://").split("/")
         tenant_name, account_name = split_url[0], split_url[4]
@@ -148,13 +165,20 @@ class OneDriveShareTransferManager:
     @classmethod
     def get_transfer(cls, conf, path, args):
         OneDriveShareTransferDownloadTask.chunk_size = args.chunk_size
-        OneDriveShareTransferDownloadTask.http = conf.get("http", {})
+        OneDriveShareTransferDownloadTask.connections = args.download_connections
+        PooledSession.pool_maxsize = args.workers + args.large_workers
         is_folder = conf.get("is_folder", False)
-        return cls(path=path, is_folder=is_folder)
+        return cls(path=path, is_folder=is_folder, http=conf.get("http", {}))
+
+    def get_stats(self):
+        return self.s.get_stats()
 
     def iter_tasks(self):
         for url, name, size in self._iter_items(self.ref_path):
             yield OneDriveShareTransferDownloadTask(url, name, size, self.s)
 
+    def bind_task(self, task):
+        task.s = self.s
+
     def get_worker(self, task):
         pass
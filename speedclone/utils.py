@@ -1,9 +1,9 @@
 # import functools
 import os
 import time
+from datetime import datetime, timezone
 
 from colorama import Fore, init
-from tqdm.autonotebook import tqdm
 
 init()
 
@@ -12,14 +12,13 @@ class DataIter:
     def __init__(self, file_piece, step_size, bar):
         self.bar = bar
         self.step_size = step_size
-        self.file_piece = file_piece
+        self.file_piece = memoryview(file_piece)
 
     def __iter__(self):
-        while self.file_piece:
-            step = self.file_piece[: self.step_size]
+        for start in range(0, len(self.file_piece), self.step_size):
+            step = self.file_piece[start : start + self.step_size]
             yield step
             self.bar.update(len(step))
-            self.file_piece = self.file_piece[self.step_size :]
 
     def __len__(self):
         return len(self.file_piece)
@@ -30,6 +29,33 @@ def norm_path(*path):
     return "/".join(norm)
 
 
+def parse_time(s):
+    # RFC 3339 times from Drive and Graph, to a unix timestamp.
+    if not s:
+        return None
+    t = datetime.strptime(s[:19], "%Y-%m-%dT%H:%M:%S")
+    return t.replace(tzinfo=timezone.utc).timestamp()
+
+
+def format_time(timestamp):
+    t = datetime.fromtimestamp(timestamp, timezone.utc)
+    return t.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def is_same_file(src, dst):
+    # Compare the metadata of a source and a destination file. Checksums win
+    # when both sides have the same kind, otherwise a destination that is not
+    # older than the source counts as up to date.
+    if src.get("size") != dst.get("size"):
+        return False
+    for key in ("md5", "quickxor"):
+        if src.get(key) and dst.get(key):
+            return src[key] == dst[key]
+    if src.get("mtime") and dst.get("mtime"):
+        return src["mtime"] - dst["mtime"] < 1
+    return True
+
+
 def get_now_time():
     return "[" + time.strftime("%H:%M:%S", time.localtime()) + "]"
 
@@ -43,7 +69,20 @@ def iter_path(path):
                 yield os.path.join(root, filename)
 
 
+def shard_paths(paths, shard=None):
+    # Under --processes each worker process takes every n-th account, so no
+    # two processes share one.
+    paths = sorted(paths)
+    if shard:
+        index, count = shard
+        paths = paths[index::count]
+    return paths
+
+
 def console_write(mode, message):
+    # tqdm is slow to import and most runs print nothing through here.
+    from tqdm.autonotebook import tqdm
+
     if mode == "sleep":
         tqdm.write(
             "{color}[{message}]{reset}".format(
@@ -65,6 +104,13 @@ def console_write(mode, message):
             )
         )
 
+    elif mode == "stats":
+        tqdm.write(
+            "{color}[{message}]{reset}".format(
+                color=Fore.GREEN, message=message, reset=Fore.RESET
+            )
+        )
+
     elif mode == "fail":
         tqdm.write(
             "{color}[{message}]{reset}".format(
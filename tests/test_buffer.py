@@ -0,0 +1,43 @@
+import os
+import threading
+import time
+
+from speedclone.buffer import iter_readinto, prefetch
+
+
+def read_slowly(path, chunk_size, depth, delay, out):
+    with open(path, "rb", buffering=0) as f:
+        pieces = []
+        for piece in prefetch(iter_readinto(f, chunk_size, depth + 1), depth):
+            # A slow PUT, so the reader reaches EOF while chunks are held.
+            time.sleep(delay)
+            pieces.append(bytes(piece))
+        out[path] = b"".join(pieces)
+
+
+def test_prefetch_keeps_buffers_until_consumed(tmp_path):
+    # An odd size gets a pool of its own.
+    chunk_size = 4099
+    files = {}
+    for name, chunks in (("slow", 3), ("fast", 20)):
+        path = str(tmp_path / name)
+        files[path] = os.urandom(chunk_size * chunks)
+        with open(path, "wb") as f:
+            f.write(files[path])
+
+    out = {}
+    slow, fast = files
+    threads = [
+        threading.Thread(target=read_slowly, args=(slow, chunk_size, 2, 0.05, out)),
+        threading.Thread(target=read_slowly, args=(fast, chunk_size, 2, 0, out)),
+    ]
+    threads[0].start()
+    # Start the second file once the first one has been read to the end,
+    # while its last two chunks are still queued.
+    time.sleep(0.07)
+    threads[1].start()
+    for t in threads:
+        t.join()
+
+    assert out[slow] == files[slow]
+    assert out[fast] == files[fast]